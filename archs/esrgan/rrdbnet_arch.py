@@ -2,6 +2,7 @@ import torch
 torch.cuda.empty_cache()
 from torch import nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 from utils.esrgan.registry import ARCH_REGISTRY
 from .arch_util import default_init_weights, make_layer
@@ -73,9 +74,15 @@ class RRDBNet(nn.Module):
             Default: 64
         num_block (int): Block number in the trunk network. Defaults: 23
         num_grow_ch (int): Channels for each growth. Default: 32.
+        checkpoint_blocks (int): Number of RRDB blocks per gradient
+            checkpoint segment during training. The activations inside a
+            segment are recomputed in the backward pass instead of being
+            stored, trading compute for memory. 0 disables checkpointing.
+            Default: 0.
     """
-    def __init__(self, num_in_ch, num_out_ch, num_feat=64, num_block=23, num_grow_ch=32):
+    def __init__(self, num_in_ch, num_out_ch, num_feat=64, num_block=23, num_grow_ch=32, checkpoint_blocks=0):
         super(RRDBNet, self).__init__()
+        self.checkpoint_blocks = checkpoint_blocks
         self.conv_first = nn.Conv2d(num_in_ch, num_feat, 3, 1, 1)
         self.body = make_layer(RRDB, num_block, num_feat=num_feat, num_grow_ch=num_grow_ch)
         self.conv_body = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
@@ -87,9 +94,16 @@ class RRDBNet(nn.Module):
 
         self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
 
+    def forward_body(self, feat):
+        if self.checkpoint_blocks > 0 and self.training and torch.is_grad_enabled():
+            for i in range(0, len(self.body), self.checkpoint_blocks):
+                feat = checkpoint(self.body[i:i + self.checkpoint_blocks], feat)
+            return feat
+        return self.body(feat)
+
     def forward(self, x):
         feat = self.conv_first(x)
-        body_feat = self.conv_body(self.body(feat))
+        body_feat = self.conv_body(self.forward_body(feat))
         feat = feat + body_feat
         # upsample
         #aqui he canviat scale_factor 3
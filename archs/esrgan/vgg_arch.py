@@ -70,6 +70,9 @@ class VGGFeatureExtractor(nn.Module):
         remove_pooling (bool): If true, the max pooling operations in VGG net
             will be removed. Default: False.
         pooling_stride (int): The stride of max pooling operation. Default: 2.
+        channels_last (bool): If True, run the network in channels-last memory
+            format, which is usually faster for convolutions on CPU.
+            Default: False.
     """
 
     def __init__(self,
@@ -79,12 +82,14 @@ class VGGFeatureExtractor(nn.Module):
                  range_norm=False,
                  requires_grad=False,
                  remove_pooling=False,
-                 pooling_stride=2):
+                 pooling_stride=2,
+                 channels_last=False):
         super(VGGFeatureExtractor, self).__init__()
 
         self.layer_name_list = layer_name_list
         self.use_input_norm = use_input_norm
         self.range_norm = range_norm
+        self.channels_last = channels_last
 
         self.names = NAMES[vgg_type.replace('_bn', '')]
         if 'bn' in vgg_type:
@@ -118,9 +123,16 @@ class VGGFeatureExtractor(nn.Module):
                     modified_net[k] = nn.MaxPool2d(kernel_size=2, stride=pooling_stride)
             else:
                 modified_net[k] = v
-        print(modified_net)
         self.vgg_net = nn.Sequential(modified_net)
 
+        # a requested feature has to be copied only if the next layer
+        # modifies it in place (e.g. conv5_4 followed by relu5_4)
+        layer_names = list(modified_net.keys())
+        self._clone_keys = set()
+        for k, next_layer in zip(layer_names[:-1], list(modified_net.values())[1:]):
+            if k in layer_name_list and getattr(next_layer, 'inplace', False):
+                self._clone_keys.add(k)
+
         if not requires_grad:
             self.vgg_net.eval()
             for param in self.parameters():
@@ -136,6 +148,9 @@ class VGGFeatureExtractor(nn.Module):
             # the std is for image with range [0, 1]
             self.register_buffer('std', torch.Tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
 
+        if self.channels_last:
+            self.vgg_net = self.vgg_net.to(memory_format=torch.channels_last)
+
     def forward(self, x):
         """Forward function.
         Args:
@@ -143,19 +158,28 @@ class VGGFeatureExtractor(nn.Module):
         Returns:
             Tensor: Forward results.
         """
-        print(x.shape)
         if self.range_norm:
             x = (x + 1) / 2
         if self.use_input_norm:
             x = (x - self.mean) / self.std
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
 
         output = {}
         for key, layer in self.vgg_net._modules.items():
-            '''print(layer)
-            print(key)
-            print(layer(x))'''
             x = layer(x)
             if key in self.layer_name_list:
-                output[key] = x.clone()
+                output[key] = x.clone() if key in self._clone_keys else x
 
-        return output
\ No newline at end of file
+        return output
+
+    @torch.no_grad()
+    def forward_gt(self, x):
+        """Forward function for targets (e.g. the gt branch of perceptual
+        loss), without building the backward graph.
+        Args:
+            x (Tensor): Input tensor with shape (n, c, h, w).
+        Returns:
+            Tensor: Forward results.
+        """
+        return self.forward(x.detach())
\ No newline at end of file
@@ -0,0 +1,85 @@
+import argparse
+import time
+
+import torch
+
+from models.liif import models as models_liif
+from utils.utils_liif import make_coord
+
+#########################
+# LIIF inference throughput
+#########################
+
+def build_model(model_fn=None):
+    """Load a LIIF checkpoint, or build an untrained edsr-baseline LIIF"""
+    if model_fn is not None:
+        model_spec = torch.load(model_fn, map_location='cpu')['model']
+        return models_liif.make(model_spec, load_sd=True)
+    model_spec = {
+        'name': 'liif',
+        'args': {
+            'encoder_spec': {'name': 'edsr-baseline', 'args': {'no_upsampling': True}},
+            'imnet_spec': {'name': 'mlp', 'args': {'out_dim': 3, 'hidden_list': [256, 256, 256, 256]}}
+        }
+    }
+    return models_liif.make(model_spec)
+
+def benchmark(model, inp_size=64, scale=3, bsize=30000, n_iter=5, device='cpu', grid=False):
+    """Time LIIF.batched_predict (or predict_grid) on a random input, returns output pixels per second"""
+    model = model.to(device).eval()
+    inp = torch.rand(1, 3, inp_size, inp_size, device=device)
+    h = w = inp_size * scale
+    coord = make_coord((h, w)).to(device).unsqueeze(0)
+    cell = torch.ones_like(coord)
+    cell[:, :, 0] *= 2 / h
+    cell[:, :, 1] *= 2 / w
+
+    if grid:
+        predict = lambda: model.predict_grid(inp, scale, bsize)
+    else:
+        predict = lambda: model.batched_predict(inp, coord, cell, bsize)
+
+    predict()  # warm up
+    t0 = time.time()
+    for _ in range(n_iter):
+        predict()
+    elapsed = (time.time() - t0) / n_iter
+    return h * w / elapsed, elapsed
+
+def check_grid(model, inp_size=64, scale=3, bsize=30000, device='cpu'):
+    """Max abs difference between predict_grid and the general batched_predict path"""
+    model = model.to(device).eval()
+    inp = torch.rand(1, 3, inp_size, inp_size, device=device)
+    h = w = inp_size * scale
+    coord = make_coord((h, w)).to(device).unsqueeze(0)
+    cell = torch.ones_like(coord)
+    cell[:, :, 0] *= 2 / h
+    cell[:, :, 1] *= 2 / w
+    ref = model.batched_predict(inp, coord, cell, bsize)
+    return (model.predict_grid(inp, scale, bsize) - ref).abs().max().item()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LIIF inference throughput')
+    parser.add_argument('--model', default=None, help='LIIF checkpoint, random weights if omitted')
+    parser.add_argument('--inp_size', type=int, default=64)
+    parser.add_argument('--scale', type=int, default=3)
+    parser.add_argument('--bsize', type=int, default=30000, help='coordinates per query chunk')
+    parser.add_argument('--n_iter', type=int, default=5)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--grid', action='store_true', help='use the integer-scale regular grid path')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    model = build_model(args.model)
+    if args.grid:
+        diff = check_grid(model, args.inp_size, args.scale, args.bsize, args.device)
+        print(f'grid path max abs difference to the general path: {diff:.3e}')
+
+    pix_per_s, elapsed = benchmark(
+        model, args.inp_size, args.scale, args.bsize, args.n_iter, args.device, args.grid
+    )
+    print(f'{args.device}{" grid" if args.grid else ""} x{args.scale} {args.inp_size}px input, bsize {args.bsize}: '
+          f'{elapsed:.3f} s/img, {pix_per_s / 1e6:.3f} Mpix/s')
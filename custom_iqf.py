@@ -6,15 +6,21 @@ import cv2
 import piq
 import torch
 import yaml
-import signal
 import time
 import math
+import copy
+import threading
+import hashlib
+import socket
+import multiprocessing
 
 import numpy as np
 import PIL.Image as pil_image
 
 from glob import glob
-from torch.utils.data import DataLoader
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import DataLoader, Dataset
 from typing import Any, Dict, Optional, List,Union,Tuple
 from iq_tool_box.datasets import DSModifier
 from iq_tool_box.metrics import Metric
@@ -30,7 +36,7 @@ from torchvision import transforms
 import kornia
 
 # MSRN
-from msrn.msrn import load_msrn_model, process_file_msrn
+from msrn.msrn import load_msrn_model, process_file_msrn, inference_cost, InferenceTimeout
 
 # FSRCNN
 from utils.utils_fsrcnn import convert_ycbcr_to_rgb, preprocess
@@ -45,19 +51,119 @@ from models.liif import models as models_liif
 import esrgan
 from models.esrgan import RRDBNet_arch as arch
 
+# Compiled inference
+from utils.utils_engine import InferenceEngine
+from utils.utils_quant import load_or_quantize, save_drift
+from utils.utils_engine import model_fingerprint
+
+# ONNX Runtime
+from utils.utils_onnx import export_onnx, OrtModel
+
 # Metrics
 from swd import SlicedWassersteinDistance
 
-class TimeOutException(Exception):
-    pass
+class BudgetExceeded(Exception):
+    """Every attempt of a BudgetExecutor timed out"""
+    def __init__(self, timeouts: List[Dict[str, Any]]):
+        super().__init__(f'time budget exceeded by all attempts: {timeouts}')
+        self.timeouts = timeouts
+
+class BudgetExecutor():
+    """
+    Runs an inference function with a time budget per attempt, retrying with
+    the next (cheaper) settings when it times out.
+    Cancellation is cooperative: fn gets an absolute deadline and raises
+    InferenceTimeout once it has passed (checked between windows), so unlike
+    signal.alarm it works from any thread or subprocess. An attempt made of a
+    single window can only be stopped before it starts.
 
-def alarm_handler(signum, frame):
-    print("ALARM signal received")
-    raise TimeOutException()
+    Args:
+        budget: float. Seconds per attempt
+        attempts: list. Keyword arguments of fn for each attempt, in order
+        cost: callable. cost(attempt, *args) estimates the work of an attempt;
+            after a timeout, later attempts that are not cheaper are skipped
+    """
+    def __init__(self, budget: float, attempts: List[Dict[str, Any]], cost: Optional[Any] = None):
+        self.budget   = budget
+        self.attempts = attempts
+        self.cost     = cost
+
+    def run(self, fn: Any, *args: Any) -> Tuple[Any, Dict[str, Any], List[Dict[str, Any]]]:
+        """Returns the result, the successful attempt and the timed out ones"""
+        timeouts = []
+        max_cost = None
+        for attempt in self.attempts:
+            cost = self.cost(attempt, *args) if self.cost is not None else None
+            if max_cost is not None and cost >= max_cost:
+                continue
+            t0 = time.time()
+            try:
+                return fn(*args, deadline=t0 + self.budget, **attempt), attempt, timeouts
+            except InferenceTimeout:
+                timeouts.append(dict(attempt, elapsed=time.time() - t0))
+                max_cost = cost
+        raise BudgetExceeded(timeouts)
 
 class Args():
     def __init__(self):
         pass
+
+class _NamedDataset(Dataset):
+    """Adds the source filename to every sample of a LIIF wrapper dataset"""
+    def __init__(self, dataset: Any, filenames: List[str]):
+        self.dataset = dataset
+        self.filenames = filenames
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        sample = self.dataset[idx]
+        sample['filename'] = self.filenames[idx % len(self.filenames)]
+        return sample
+
+def _model_device(model: Any) -> torch.device:
+    """Device of the first parameter of model, the cpu if it has none (e.g. onnxruntime parts)"""
+    for p in model.parameters():
+        return p.device
+    return torch.device('cpu')
+
+def _input_dim(model: Any, layer_type: type, attr: str, default: int) -> int:
+    """Input size of the first layer_type layer of model (e.g. in_channels of the
+    first Conv2d), default if it has none"""
+    for m in model.modules():
+        if isinstance(m, layer_type):
+            return getattr(m, attr)
+    return default
+
+def _size_batches(image_file_lst: List[str], batch_size: int) -> List[List[int]]:
+    """Group image indices by image size (read from the headers) into batches"""
+    groups = {}
+    for idx, image_file in enumerate(image_file_lst):
+        with pil_image.open(image_file) as img:
+            groups.setdefault(img.size, []).append(idx)
+    return [
+        idx_lst[i:i + batch_size]
+        for idx_lst in groups.values()
+        for i in range(0, len(idx_lst), batch_size)
+    ]
+
+class _ClaimingBatchSampler():
+    """Batch sampler that claims the images of each batch when the DataLoader asks
+    for it, rather than all upfront, skipping images claimed by another run"""
+    def __init__(self, batches: List[List[int]], image_file_lst: List[str], manifest: Any):
+        self.batches = batches
+        self.image_file_lst = image_file_lst
+        self.manifest = manifest
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def __iter__(self) -> Any:
+        for batch in self.batches:
+            claimed = [idx for idx in batch if self.manifest.claim(self.image_file_lst[idx])]
+            if claimed:
+                yield claimed
     
 class ModelConfS3Loader():
     
@@ -67,7 +173,10 @@ class ModelConfS3Loader():
         config_fn_lst = [],
         bucket_name   = "image-quality-framework",
         algo          = "FSRCNN",
-        zoom          = 3
+        zoom          = 3,
+        engine        = None,
+        onnx          = False,
+        ort_threads   = None
     ):
         
         self.fn_dict = {
@@ -81,6 +190,11 @@ class ModelConfS3Loader():
         self.bucket_name        =  bucket_name
         self.algo               =  algo
         self.zoom               =  3
+        # None/'eager', 'trace' or 'compile', see utils.utils_engine.InferenceEngine
+        self.engine             =  engine
+        # export to onnx and run with onnxruntime on the cpu (takes precedence over engine)
+        self.onnx               =  onnx
+        self.ort_threads        =  ort_threads
         
     def load_ai_model_and_stuff(self) -> List[Any]:
         
@@ -159,8 +273,56 @@ class ModelConfS3Loader():
                 print(f"Error: unknown algo: {self.algo}")
                 raise
 
+            if self.onnx:
+                model = self._to_onnx(model)
+            elif self.engine not in (None, 'eager') and self.algo in ('FSRCNN', 'MSRN', 'ESRGAN'):
+                model = InferenceEngine(
+                    model, self.algo, mode=self.engine,
+                    cache_dir=os.environ.get('SISR_ENGINE_CACHE')
+                )
+
             return model , args
     
+    def _to_onnx( self, model: Any ) -> Any:
+        """Export the network (for LIIF, its encoder and imnet) to onnx with dynamic
+        spatial axes, cached per model fingerprint, and wrap it in an OrtModel.
+        If the export fails, the torch model is returned unchanged"""
+        
+        cache_dir = os.environ.get('SISR_ENGINE_CACHE') or os.path.expanduser('~/.cache/sisr_engines')
+        
+        def ort_model(net, part, example_input, spatial=True):
+            onnx_fn = os.path.join(cache_dir, f"{self.algo}_{part}_{fingerprint}.onnx")
+            if not os.path.exists(onnx_fn):
+                print(f"Exporting {self.algo} {part} to {onnx_fn}")
+                export_onnx(net, example_input, onnx_fn, spatial=spatial)
+            return OrtModel(onnx_fn, intra_op_num_threads=self.ort_threads)
+        
+        def image_input(net, size):
+            # the channels come from the first convolution of the network
+            return torch.rand(1, _input_dim(net, torch.nn.Conv2d, 'in_channels', 3), size, size)
+        
+        try:
+            fingerprint = model_fingerprint(model)
+            onnx_model = copy.deepcopy(model).cpu().float().eval()
+            if self.algo=='LIIF':
+                # the coordinate queries stay in torch, encoder and imnet run in onnxruntime;
+                # both are exported before either replaces its torch module
+                encoder = ort_model(onnx_model.encoder, 'encoder', image_input(onnx_model.encoder, 48))
+                imnet = None
+                if onnx_model.imnet is not None:
+                    in_dim = _input_dim(onnx_model.imnet, torch.nn.Linear, 'in_features', None)
+                    imnet = ort_model(onnx_model.imnet, 'imnet', torch.rand(64, in_dim), spatial=False)
+                del onnx_model.encoder
+                onnx_model.encoder = encoder
+                if imnet is not None:
+                    del onnx_model.imnet
+                    onnx_model.imnet = imnet
+                return onnx_model
+            return ort_model(onnx_model, 'model', image_input(onnx_model, 32))
+        except Exception as e:
+            print(f"ONNX export of {self.algo} failed ({e}), using the torch model")
+            return model
+    
     def _load_args( self, config_fn: str ) -> Any:
         """Load Args"""
 
@@ -196,7 +358,7 @@ class ModelConfS3Loader():
     def _load_model_liif(self,model_fn: str,args: Any,yml_fn: str) -> Any:
         """Load Model"""
         
-        os.environ['CUDA_VISIBLE_DEVICES'] = "0"
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         
         with open(yml_fn, 'r') as f:
             config = yaml.load(f, Loader=yaml.FullLoader)
@@ -206,8 +368,8 @@ class ModelConfS3Loader():
         self.config = config
         self.spec = spec
         
-        model_spec = torch.load(model_fn)['model']
-        model = models_liif.make(model_spec, load_sd=True).cuda()
+        model_spec = torch.load(model_fn, map_location='cpu')['model']
+        model = models_liif.make(model_spec, load_sd=True).to(device)
         
         model.eval()
         
@@ -219,15 +381,497 @@ class ModelConfS3Loader():
 
     def _load_model_esrgan(self,model_fn: str) -> Any:
         """Load ESRGAN Model"""
-        device = torch.device('cuda')
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         model = arch.RRDBNet(3, 3, 64, 23, gc=32)
         #model.load_state_dict(torch.load(args.model_path), strict=True)
-        weights = torch.load(model_fn)
+        weights = torch.load(model_fn, map_location='cpu')
         model.load_state_dict(weights['params'])
         model.eval()
         model = model.to(device)
         return model
 
+#########################
+# Output writer
+#########################
+
+class AsyncImageWriter():
+    """
+    Bounded pool of background threads that encode and save output images,
+    so that encoding overlaps with inference of the next images.
+
+    Args:
+        num_workers: int. Number of writer threads
+        max_pending: int. Images queued or being written at most; submit()
+            blocks when the pool is full (backpressure)
+
+    Attributes:
+        encode_time: float. Total seconds spent encoding and writing
+        n_written: int. Number of images written
+    """
+    def __init__(self, num_workers: int = 4, max_pending: int = 16):
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._slots    = threading.BoundedSemaphore(max_pending)
+        self._lock     = threading.Lock()
+        self._idle     = threading.Condition(self._lock)
+        self._n_pending = 0
+        self.encode_time = 0.0
+        self.n_written   = 0
+
+    def submit(
+        self, img: np.array, image_file: str, backend: str = 'cv2', on_done: Optional[Any] = None
+    ) -> None:
+        """Queue img to be saved to image_file with cv2 (BGR) or PIL (RGB).
+        on_done(exception) is called from the writer thread once written, with None on success.
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._n_pending += 1
+        future = self._executor.submit(self._write, img, image_file, backend)
+        future.add_done_callback(partial(self._done, on_done=on_done))
+
+    def wait(self) -> None:
+        """Block until every queued image is written and its on_done callback has returned"""
+        with self._idle:
+            while self._n_pending:
+                self._idle.wait()
+
+    def _write(self, img: np.array, image_file: str, backend: str) -> None:
+        t0 = time.time()
+        if backend == 'pil':
+            pil_image.fromarray(img).save(image_file)
+        elif not cv2.imwrite(image_file, img):
+            raise IOError(f'Could not write {image_file}')
+        with self._lock:
+            self.encode_time += time.time() - t0
+            self.n_written += 1
+
+    def _done(self, future: Any, on_done: Optional[Any] = None) -> None:
+        if future.exception() is not None:
+            print(future.exception())
+        try:
+            if on_done is not None:
+                on_done(future.exception())
+        finally:
+            with self._idle:
+                self._n_pending -= 1
+                self._idle.notify_all()
+            self._slots.release()
+
+_IMAGE_WRITER = None
+
+def get_image_writer() -> AsyncImageWriter:
+    """Writer pool shared by all the DSModifiers of the process"""
+    global _IMAGE_WRITER
+    if _IMAGE_WRITER is None:
+        _IMAGE_WRITER = AsyncImageWriter(
+            num_workers = int(os.environ.get('IQF_WRITER_WORKERS', 4)),
+            max_pending = int(os.environ.get('IQF_WRITER_MAX_PENDING', 16))
+        )
+    return _IMAGE_WRITER
+
+def _print_times(compute_time: float, encode_time: float, n_img: int) -> None:
+    print(f'Done. {n_img} images, compute {compute_time:.1f}s, encode {encode_time:.1f}s')
+
+#########################
+# Run manifest
+#########################
+
+# params that change how a pass runs, not what it produces; all the others
+# (e.g. engine, onnx, quant_calib, time_budget, retry_tiles) are hashed
+_RUNTIME_PARAMS = (
+    'resume', 'batch_size', 'num_workers', 'n_procs', 'n_shards', 'shard_index',
+    'threads', 'ort_threads', 'pin_cores', 'cores'
+)
+
+class RunManifest():
+    """
+    Records every output of a DSModifier pass with its input hash, model id
+    and params, in one json file per image. Reruns only process missing or
+    stale images, and parallel runs sharing dst claim images atomically.
+    Records and claims live in <mod_path>/.manifest/<input_name>/, next to
+    (not inside) the dst = <mod_path>/<input_name> output folder.
+
+    Args:
+        dst: str. Output folder of the pass
+        model_id: str. Model identifier stored in the records
+        params: dict. Modifier params, runtime-only keys are ignored
+        resume: bool. If False, every image is pending again (records are still written)
+        claim_timeout: float. Seconds without heartbeat after which a claim is taken over
+        heartbeat: float. Seconds between refreshes of the claims held by this run
+
+    A claim is stale, and taken over, if its process is gone (same host) or
+    if its heartbeat stopped for claim_timeout seconds (other hosts). Call
+    close() at the end of the pass to release leftover claims.
+    """
+    def __init__(
+        self,
+        dst: str,
+        model_id: str,
+        params: Dict[str, Any],
+        resume: bool = True,
+        claim_timeout: float = 600,
+        heartbeat: float = 60
+    ):
+        root = os.path.join(os.path.dirname(dst), '.manifest', os.path.basename(dst))
+        self.root          = root
+        self.dst           = dst
+        self.record_dir    = os.path.join(root, 'records')
+        self.claim_dir     = os.path.join(root, 'claims')
+        self.model_id      = model_id
+        self.resume        = resume
+        self.claim_timeout = claim_timeout
+        self.heartbeat     = heartbeat
+        self.n_skipped     = 0
+        self.params_hash   = hashlib.sha1(json.dumps(
+            {k: v for k, v in params.items() if k not in _RUNTIME_PARAMS},
+            sort_keys=True, default=str
+        ).encode()).hexdigest()
+        self._hashes = {}
+        self._held   = set()
+        self._lock   = threading.Lock()
+        self._stop   = threading.Event()
+        self._heartbeat_thread = None
+        os.makedirs(self.record_dir, exist_ok=True)
+        os.makedirs(self.claim_dir, exist_ok=True)
+
+    def input_hash(self, image_file: str) -> str:
+        """sha1 of the input file contents"""
+        if image_file not in self._hashes:
+            sha = hashlib.sha1()
+            with open(image_file, 'rb') as f:
+                for chunk in iter(partial(f.read, 1 << 20), b''):
+                    sha.update(chunk)
+            self._hashes[image_file] = sha.hexdigest()
+        return self._hashes[image_file]
+
+    def output_file(self, image_file: str) -> str:
+        return os.path.join(self.dst, os.path.basename(image_file))
+
+    def get(self, image_file: str) -> Optional[Dict[str, Any]]:
+        """Record of image_file, None if there is none"""
+        try:
+            with open(self._record_file(image_file)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """All the records of the pass, by input filename"""
+        records = {}
+        for fn in sorted(os.listdir(self.record_dir)):
+            if fn.endswith('.json'):
+                with open(os.path.join(self.record_dir, fn)) as f:
+                    records[fn[:-len('.json')]] = json.load(f)
+        return records
+
+    def is_done(self, image_file: str) -> bool:
+        """True if image_file has an up-to-date output"""
+        record = self.get(image_file)
+        return (
+            record is not None
+            and record['status'] == 'done'
+            and record['model'] == self.model_id
+            and record['params_hash'] == self.params_hash
+            and os.path.exists(self.output_file(image_file))
+            and record['input_hash'] == self.input_hash(image_file)
+        )
+
+    def pending(self, image_files: List[str]) -> List[str]:
+        """Images of image_files without an up-to-date output"""
+        if not self.resume:
+            return list(image_files)
+        pending = [fn for fn in image_files if not self.is_done(fn)]
+        if len(pending) < len(image_files):
+            print(f'Resuming: {len(image_files) - len(pending)} of {len(image_files)} images already done')
+        return pending
+
+    def claim(self, image_file: str) -> bool:
+        """Atomically claim image_file, False if another run is processing it"""
+        claim_file = self._claim_file(image_file)
+        for _ in range(2):
+            try:
+                fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    stat = os.stat(claim_file)
+                    stale = self._is_stale(claim_file, stat)
+                except OSError:  # released meanwhile
+                    continue
+                if not stale:
+                    break
+                self._remove_stale(claim_file, stat)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(f'{socket.gethostname()} {os.getpid()}')
+            with self._lock:
+                self._held.add(claim_file)
+            self._start_heartbeat()
+            return True
+        self.n_skipped += 1
+        return False
+
+    def release(self, image_file: str) -> None:
+        claim_file = self._claim_file(image_file)
+        with self._lock:
+            self._held.discard(claim_file)
+        self._remove(claim_file)
+
+    def close(self) -> None:
+        """Stop the heartbeat, release the claims never recorded and report the
+        images skipped because another run held them"""
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        with self._lock:
+            held, self._held = self._held, set()
+        for claim_file in held:
+            self._remove(claim_file)
+        if self.n_skipped:
+            print(f'Skipped {self.n_skipped} pending images claimed by another run')
+
+    def record(self, image_file: str, status: str, **info: Any) -> None:
+        """Write the record of image_file (status 'done', 'failed', ...) and release its claim"""
+        record = {
+            'input': os.path.basename(image_file),
+            'input_hash': self.input_hash(image_file),
+            'model': self.model_id,
+            'params_hash': self.params_hash,
+            'status': status,
+            'host': socket.gethostname(),
+            'time': time.time()
+        }
+        record.update(info)
+        record_file = self._record_file(image_file)
+        with open(record_file + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.replace(record_file + '.tmp', record_file)
+        self.release(image_file)
+
+    def on_written(self, image_file: str, **info: Any) -> Any:
+        """AsyncImageWriter on_done callback recording image_file"""
+        def callback(exception):
+            if exception is None:
+                self.record(image_file, 'done', **info)
+            else:
+                self.record(image_file, 'failed', error=str(exception), **info)
+        return callback
+
+    def _record_file(self, image_file: str) -> str:
+        return os.path.join(self.record_dir, os.path.basename(image_file) + '.json')
+
+    def _claim_file(self, image_file: str) -> str:
+        return os.path.join(self.claim_dir, os.path.basename(image_file) + '.claim')
+
+    def _is_stale(self, claim_file: str, stat: os.stat_result) -> bool:
+        """True if the run holding claim_file crashed"""
+        if time.time() - stat.st_mtime > self.claim_timeout:
+            return True
+        with open(claim_file) as f:
+            owner = f.read().split()
+        if len(owner) != 2 or owner[0] != socket.gethostname():
+            return False
+        try:
+            os.kill(int(owner[1]), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            pass
+        return False
+
+    def _remove_stale(self, claim_file: str, stat: os.stat_result) -> None:
+        """Remove claim_file unless another run took it over since stat"""
+        try:
+            current = os.stat(claim_file)
+        except FileNotFoundError:
+            return
+        if (current.st_ino, current.st_mtime) == (stat.st_ino, stat.st_mtime):
+            self._remove(claim_file)
+
+    def _start_heartbeat(self) -> None:
+        if self._heartbeat_thread is None:
+            self._stop.clear()
+            self._heartbeat_thread = threading.Thread(target=self._beat, daemon=True)
+            self._heartbeat_thread.start()
+
+    def _beat(self) -> None:
+        """Refresh the mtime of the held claims until close()"""
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                held = list(self._held)
+            for claim_file in held:
+                try:
+                    os.utime(claim_file)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _open_manifest(modifier: DSModifier, dst: str) -> RunManifest:
+    """Manifest of a modifier pass writing to dst"""
+    return RunManifest(
+        dst,
+        model_id = modifier.params.get('model', modifier.name),
+        params   = modifier.params,
+        resume   = modifier.params.get('resume', True)
+    )
+
+#########################
+# Sharded execution
+#########################
+
+def _shard_files(image_files: List[str], params: Dict[str, Any]) -> List[str]:
+    """Slice params['shard_index'] of params['n_shards'] of the sorted image_files"""
+    n_shards    = params.get('n_shards', 1)
+    shard_index = params.get('shard_index', 0)
+    return sorted(image_files)[shard_index::n_shards]
+
+def _shard_worker(
+    modifier: DSModifier, data_input: str, mod_path: str, shard_params: Dict[str, Any], log_file: str
+) -> None:
+    """Run one local shard of a modifier pass, logging to log_file"""
+    sys.stdout = sys.stderr = open(log_file, 'w', buffering=1)
+    if 'cores' in shard_params and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, shard_params['cores'])
+    torch.set_num_threads(shard_params['threads'])
+    modifier.params.update(shard_params)
+    modifier._ds_input_modification(data_input, mod_path)
+
+def _run_local_shards(modifier: DSModifier, data_input: str, mod_path: str) -> str:
+    """
+    Split the pass of modifier over params['n_procs'] local processes, each with its
+    own copy of the model and params['threads'] torch threads (default: cores / n_procs).
+    Combined with params['n_shards'] / params['shard_index'], several nodes sharing
+    mod_path split the work, every node running n_procs processes.
+    Outputs go to the same folder and manifest; shard logs are merged once all finish.
+    """
+    params      = modifier.params
+    n_procs     = params['n_procs']
+    n_shards    = params.get('n_shards', 1)
+    shard_index = params.get('shard_index', 0)
+    threads     = params.get('threads', max(1, (os.cpu_count() or 1) // n_procs))
+
+    input_name = os.path.basename(data_input)
+    manifest   = _open_manifest(modifier, os.path.join(mod_path, input_name))
+    log_dir    = os.path.join(manifest.root, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+
+    if params.get('quantize'):
+        # quantize once here (the quantizable modifiers read *.tif), the shards load
+        # the cached int8 model; a failure is kept so that they use fp32 right away
+        fp32_model, fp32_device = modifier.model, modifier.__dict__.get('device')
+        _setup_quantization(modifier, glob(os.path.join(data_input, '*.tif')))
+        if modifier.model is not fp32_model:
+            # TorchScript models can not be pickled
+            modifier.model, modifier._quantized = fp32_model, False
+            if fp32_device is not None:
+                modifier.device = fp32_device
+
+    ctx = multiprocessing.get_context('spawn')
+    procs, log_files = [], []
+    for p in range(n_procs):
+        shard_params = {
+            'n_procs': 1,
+            'n_shards': n_shards * n_procs,
+            'shard_index': shard_index * n_procs + p,
+            'threads': threads
+        }
+        if params.get('pin_cores', False):
+            # disjoint cores per process, onnxruntime sizes its pool from them
+            n_cores = os.cpu_count() or 1
+            shard_params['cores'] = sorted(set(c % n_cores for c in range(p * threads, (p + 1) * threads)))
+        log_file = os.path.join(log_dir, f"shard_{shard_params['shard_index']:03d}.log")
+        proc = ctx.Process(
+            target=_shard_worker, args=(modifier, data_input, mod_path, shard_params, log_file)
+        )
+        proc.start()
+        procs.append(proc)
+        log_files.append(log_file)
+
+    failed = []
+    for proc, log_file in zip(procs, log_files):
+        proc.join()
+        if proc.exitcode != 0:
+            failed.append(log_file)
+
+    merged_log = os.path.join(log_dir, f'node_{shard_index:03d}.log')
+    with open(merged_log, 'w') as merged:
+        for log_file in log_files:
+            with open(log_file) as f:
+                merged.write(f'##### {os.path.basename(log_file)}\n')
+                merged.write(f.read())
+    with open(merged_log) as f:
+        print(f.read())
+
+    status = {}
+    for record in manifest.load().values():
+        status[record['status']] = status.get(record['status'], 0) + 1
+    print(f'{n_procs} shards done, records: {status}')
+    if failed:
+        raise RuntimeError(f'Shards failed, see {failed}')
+    
+    return input_name
+
+#########################
+# Quantized inference
+#########################
+
+def _setup_quantization(modifier: DSModifier, image_files: List[str]) -> None:
+    """
+    Replaces modifier.model by a static int8 CPU model when params['quantize'] is set.
+    The model is calibrated by running _mod_img on the first params['quant_calib']
+    (default 8) images of the pass, cached next to the compiled engines, and its
+    ssim/psnr drift against the fp32 model on the calibration inputs is reported.
+    Falls back to fp32 if the model cannot be quantized.
+    """
+    if not modifier.params.get('quantize') or getattr(modifier, '_quantized', False):
+        return
+    
+    fp32_model = modifier.model
+    if isinstance(fp32_model, InferenceEngine):
+        fp32_model = fp32_model.model
+    calib_files = sorted(image_files)[:modifier.params.get('quant_calib', 8)]
+    if not calib_files:
+        return
+    
+    def calibrate(recorder):
+        modifier.model = recorder
+        try:
+            for image_file in calib_files:
+                modifier._mod_img( image_file )
+        finally:
+            modifier.model = fp32_model
+    
+    try:
+        qmodel, info = load_or_quantize(
+            fp32_model, modifier.params['algo'], calibrate,
+            [os.path.basename(fn) for fn in calib_files],
+            backend   = modifier.params.get('quant_backend', 'fbgemm'),
+            cache_dir = os.environ.get('SISR_ENGINE_CACHE')
+        )
+    except Exception as e:
+        print(f'Quantization failed ({e}), using the fp32 model')
+        modifier._quantized = True
+        return
+    
+    if info['inputs'] is not None:
+        fp32_device = _model_device(fp32_model)
+        with torch.no_grad():
+            refs  = [fp32_model(x.to(fp32_device)) for x in info['inputs']]
+            preds = [qmodel(x) for x in info['inputs']]
+        info['drift'] = SimilarityMetrics.drift(preds, refs)
+        save_drift(info['cache_file'], info['drift'])
+    print(f"int8 {modifier.params['algo']} ({info['cache_file']}), drift vs fp32: {info['drift']}")
+    
+    modifier.model      = qmodel
+    modifier.device     = torch.device('cpu')
+    modifier._quantized = True
+
 #########################
 # Custom IQF
 #########################
@@ -272,7 +916,9 @@ class DSModifierLIIF(DSModifier):
                 model_fn      = params['model'],
                 config_fn_lst = [params['config0'],params['config1']],
                 bucket_name   = "image-quality-framework",
-                algo          = "LIIF"
+                algo          = "LIIF",
+                onnx          = params.get('onnx', False),
+                ort_threads   = params.get('ort_threads')
         )
         
         model,args = model_conf.load_ai_model_and_stuff()
@@ -280,6 +926,8 @@ class DSModifierLIIF(DSModifier):
         self.spec   =  model_conf.spec
         self.args   =  args
         self.model  =  model
+        # number of coordinates queried at once, None queries all of them
+        self.eval_bsize = params.get('eval_bsize', model_conf.config.get('eval_bsize', 30000))
         
     def _ds_input_modification(self, data_input: str, mod_path: str) -> str:
         """Modify images
@@ -290,17 +938,21 @@ class DSModifierLIIF(DSModifier):
         Returns:
             Name of the new folder containign the images
         """
+        if self.params.get('n_procs', 1) > 1:
+            return _run_local_shards(self, data_input, mod_path)
+        
         input_name = os.path.basename(data_input)
         dst = os.path.join(mod_path, input_name)
         os.makedirs(dst, exist_ok=True)
         
         print(f'For each image file in <{data_input}>...')
         
-        data_norm, eval_type, eval_bsize = None,None, None
+        data_norm, eval_type, eval_bsize = None,None, self.eval_bsize
         
         spec = self.spec
         
-        spec['batch_size'] = 1
+        spec['batch_size'] = self.params.get('batch_size', 4)
+        num_workers = self.params.get('num_workers', min(8, os.cpu_count() or 1))
         
         spec['dataset'] = {
             'name': 'image-folder',
@@ -309,10 +961,23 @@ class DSModifierLIIF(DSModifier):
             }
         }
         
-        dataset = datasets_liif.make(spec['dataset'])
-        dataset = datasets_liif.make(spec['wrapper'], args={'dataset': dataset})
-        loader = DataLoader(dataset, batch_size=spec['batch_size'],shuffle=False,
-                           num_workers=1, pin_memory=False ) #pin_memory=True
+        folder = datasets_liif.make(spec['dataset'])
+        dataset = datasets_liif.make(spec['wrapper'], args={'dataset': folder})
+        # samples carry their own filename, batches only hold equal-size images
+        dataset = _NamedDataset(dataset, folder.filenames)
+        image_file_lst = [os.path.join(data_input, fn) for fn in folder.filenames]
+        # only missing or stale outputs, claimed batch by batch as they are loaded
+        manifest = _open_manifest(self, dst)
+        todo = set(manifest.pending(_shard_files(image_file_lst, self.params)))
+        idx_lst = [idx for idx, fn in enumerate(image_file_lst) if fn in todo]
+        batch_sampler = _ClaimingBatchSampler([
+            [idx_lst[i] for i in batch]
+            for batch in _size_batches([image_file_lst[idx] for idx in idx_lst], spec['batch_size'])
+        ], image_file_lst, manifest)
+        # LIIF runs on whatever device the model was loaded to
+        device = _model_device(self.model)
+        loader = DataLoader(dataset, batch_sampler=batch_sampler,
+                           num_workers=num_workers, pin_memory=(device.type == 'cuda') )
         
         if data_norm is None:
         
@@ -321,10 +986,10 @@ class DSModifierLIIF(DSModifier):
                 'gt': {'sub': [0], 'div': [1]}
             }
         
-        inp_sub = torch.FloatTensor(data_norm['inp']['sub']).view(1, -1, 1, 1).cuda()
-        inp_div = torch.FloatTensor(data_norm['inp']['div']).view(1, -1, 1, 1).cuda()
-        gt_sub  = torch.FloatTensor(data_norm['gt']['sub']).view(1, 1, -1).cuda()
-        gt_div  = torch.FloatTensor(data_norm['gt']['div']).view(1, 1, -1).cuda()
+        inp_sub = torch.FloatTensor(data_norm['inp']['sub']).view(1, -1, 1, 1).to(device)
+        inp_div = torch.FloatTensor(data_norm['inp']['div']).view(1, -1, 1, 1).to(device)
+        gt_sub  = torch.FloatTensor(data_norm['gt']['sub']).view(1, 1, -1).to(device)
+        gt_div  = torch.FloatTensor(data_norm['gt']['div']).view(1, 1, -1).to(device)
 
         if eval_type is None:
             metric_fn = utils_liif.calc_psnr
@@ -340,36 +1005,53 @@ class DSModifierLIIF(DSModifier):
         val_res  = utils_liif.Averager()
         val_ssim = utils_liif.Averager() #test
 
-        #pbar = tqdm(loader, leave=False, desc='val')
-        image_file_lst = sorted( glob( os.path.join(data_input,'*.tif') ) )
-        count = 0
-        for enu,batch in enumerate(loader):
+        # outputs are saved in background threads while the next batch runs
+        writer = get_image_writer()
+        encode_time0, compute_time, n_img = writer.encode_time, 0.0, 0
+        try:
+            for batch in loader:
             
-            image_file = image_file_lst[enu]
+                filenames = batch.pop('filename')
             
-            try:
-                imgp = self._mod_img( batch, inp_sub, inp_div, eval_bsize,gt_div , gt_sub )
-                print(imgp.shape)
-                output = pil_image.fromarray((imgp*255).astype(np.uint8))
-                output.save( os.path.join(dst, os.path.basename(image_file)) )
-                #cv2.imwrite( os.path.join(dst, os.path.basename(image_file)), imgp )
-            except Exception as e:
-                print(e)
+                try:
+                    t0 = time.time()
+                    imgs = self._mod_img( batch, inp_sub, inp_div, eval_bsize,gt_div , gt_sub )
+                    compute_time += time.time() - t0
+                    for imgp, image_file in zip(imgs, filenames):
+                        output = (imgp*255).astype(np.uint8)
+                        writer.submit(
+                            output, os.path.join(dst, os.path.basename(image_file)), backend='pil',
+                            on_done=manifest.on_written(os.path.join(data_input, image_file))
+                        )
+                        n_img += 1
+                except Exception as e:
+                    print(e)
+                    for image_file in filenames:
+                        manifest.record(os.path.join(data_input, image_file), 'failed', error=str(e))
+        finally:
+            writer.wait()
+            manifest.close()
+        _print_times(compute_time, writer.encode_time - encode_time0, n_img)
             
         return input_name
 
     def _mod_img(self, batch: Any, inp_sub: Any, inp_div: Any, eval_bsize: Any, gt_div: Any, gt_sub: Any) -> None:
 
+        device = inp_sub.device
         for k, v in batch.items():
-            batch[k] = v.cuda()
+            batch[k] = v.to(device, non_blocking=True)
 
         inp = (batch['inp'] - inp_sub) / inp_div
         
-        if eval_bsize is None:
+        grid_scale = self._regular_grid_scale(batch)
+        if grid_scale is not None and self.params.get('grid_fast_path', True):
+            pred = self.model.predict_grid(inp, grid_scale,
+                                   eval_bsize or batch['coord'].shape[1])
+        elif eval_bsize is None:
             with torch.no_grad():
                 pred = self.model(inp, batch['coord'], batch['cell'])
         else:
-            pred = batched_predict(self.model, inp,
+            pred = self.model.batched_predict(inp,
                                    batch['coord'], batch['cell'], eval_bsize)
         pred = pred * gt_div + gt_sub
         pred.clamp_(0, 1)
@@ -378,7 +1060,24 @@ class DSModifierLIIF(DSModifier):
         shape = [batch['inp'].shape[0], round(ih * s), round(iw * s), 3]
         pred = pred.view(*shape) \
             .permute(0, 1, 2, 3).contiguous()
-        return pred.detach().cpu().numpy().squeeze()
+        return pred.detach().cpu().numpy()
+
+    @staticmethod
+    def _regular_grid_scale(batch: Any) -> Optional[int]:
+        """Integer scale if the batch queries the whole regular HR grid, else None"""
+        ih, iw = batch['inp'].shape[-2:]
+        s = math.sqrt(batch['coord'].shape[1] / (ih * iw))
+        scale = round(s)
+        if scale < 1 or abs(s - scale) > 1e-6:
+            return None
+        coord = batch['coord']
+        grid = utils_liif.cached_feat_coord(ih * scale, iw * scale, coord.device, coord.dtype).view(1, -1, 2)
+        if not torch.equal(coord, grid.expand_as(coord)):
+            return None
+        cell = torch.tensor([2 / (ih * scale), 2 / (iw * scale)], dtype=coord.dtype, device=coord.device)
+        if not torch.allclose(batch['cell'], cell.view(1, 1, 2).expand_as(coord)):
+            return None
+        return scale
 
 class DSModifierFSRCNN(DSModifier):
     """
@@ -416,7 +1115,10 @@ class DSModifierFSRCNN(DSModifier):
                 model_fn      = params['model'],
                 config_fn_lst = [params['config']],
                 bucket_name   = "image-quality-framework",
-                algo          = "FSRCNN"
+                algo          = "FSRCNN",
+                engine        = params.get('engine'),
+                onnx          = params.get('onnx', False),
+                ort_threads   = params.get('ort_threads')
         )
         
         self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -433,24 +1135,42 @@ class DSModifierFSRCNN(DSModifier):
         Returns:
             Name of the new folder containign the images
         """
+        if self.params.get('n_procs', 1) > 1:
+            return _run_local_shards(self, data_input, mod_path)
+        
         input_name = os.path.basename(data_input)
         dst = os.path.join(mod_path, input_name)
         os.makedirs(dst, exist_ok=True)
         
         print(f'For each image file in <{data_input}>...')
         
-        for image_file in glob( os.path.join(data_input,'*.tif') ):
-
-            try:
-                imgp = self._mod_img( image_file )
-                print( imgp.shape )
-                output = pil_image.fromarray(imgp)
-                output.save(os.path.join(dst, os.path.basename(image_file)))
-                #cv2.imwrite( os.path.join(dst, os.path.basename(image_file)), imgp )
-            except Exception as e:
-                print(e)
-        
-        print('Done.')
+        writer = get_image_writer()
+        encode_time0, compute_time, n_img = writer.encode_time, 0.0, 0
+        image_files = glob( os.path.join(data_input,'*.tif') )
+        _setup_quantization(self, image_files)
+        manifest = _open_manifest(self, dst)
+        try:
+            for image_file in manifest.pending(_shard_files(image_files, self.params)):
+
+                if not manifest.claim(image_file):
+                    continue
+
+                try:
+                    t0 = time.time()
+                    imgp = self._mod_img( image_file )
+                    compute_time += time.time() - t0
+                    writer.submit(
+                        imgp, os.path.join(dst, os.path.basename(image_file)), backend='pil',
+                        on_done=manifest.on_written(image_file)
+                    )
+                    n_img += 1
+                except Exception as e:
+                    print(e)
+                    manifest.record(image_file, 'failed', error=str(e))
+        finally:
+            writer.wait()
+            manifest.close()
+        _print_times(compute_time, writer.encode_time - encode_time0, n_img)
         
         return input_name
 
@@ -527,11 +1247,24 @@ class DSModifierMSRN(DSModifier):
                 config_fn_lst = [],
                 bucket_name   = "image-quality-framework",
                 algo          = "MSRN",
-                zoom          = self.params['zoom']
+                zoom          = self.params['zoom'],
+                engine        = self.params.get('engine'),
+                onnx          = self.params.get('onnx', False),
+                ort_threads   = self.params.get('ort_threads')
         )
         
         self.model,_ = model_conf.load_ai_model_and_stuff()
         
+        # per-image time budget. The whole image runs as one window (which the
+        # deadline cannot interrupt); opt-in retry_tiles (fractions of the LR width)
+        # are only tried when they run the network on fewer pixels than the attempt
+        # that timed out
+        self.executor = BudgetExecutor(
+            budget   = self.params.get('time_budget', 30),
+            attempts = [{'tile': tile} for tile in [1] + list(self.params.get('retry_tiles', []))],
+            cost     = self._attempt_cost
+        )
+        
     def _ds_input_modification(self, data_input: str, mod_path: str) -> str:
         """Modify images
         Iterates the data_input path loading images, processing with _mod_img(), and saving to mod_path
@@ -542,49 +1275,88 @@ class DSModifierMSRN(DSModifier):
         Returns:
             Name of the new folder containign the images
         """
+        if self.params.get('n_procs', 1) > 1:
+            return _run_local_shards(self, data_input, mod_path)
+        
         input_name = os.path.basename(data_input)
         dst = os.path.join(mod_path, input_name)
         os.makedirs(dst, exist_ok=True)
         
         print(f'For each image file in <{data_input}>...')
         
-        for image_file in glob( os.path.join(data_input,'*.tif') ):
-            
-            signal.signal(signal.SIGALRM, alarm_handler)
-            signal.alarm(5)
+        writer = get_image_writer()
+        encode_time0, compute_time, n_img = writer.encode_time, 0.0, 0
+        n_timeout, n_retried = 0, 0
+        image_files = glob( os.path.join(data_input,'*.tif') )
+        _setup_quantization(self, image_files)
+        manifest = _open_manifest(self, dst)
+        try:
+            for image_file in manifest.pending(_shard_files(image_files, self.params)):
             
-            try:
-                imgp = self._mod_img( image_file )
-                print( imgp.shape )
-                cv2.imwrite( os.path.join(dst, os.path.basename(image_file)), imgp )
-            except TimeOutException as ex:
-                print(ex)
-            except Exception as e:
-                print(e)
+                if not manifest.claim(image_file):
+                    continue
             
-            signal.alarm(0)
-        
-        print('Done.')
+                try:
+                    t0 = time.time()
+                    imgp, attempt, timeouts = self.executor.run(self._mod_img, image_file)
+                    compute_time += time.time() - t0
+                    writer.submit(
+                        imgp, os.path.join(dst, os.path.basename(image_file)),
+                        on_done=manifest.on_written(image_file, tile=attempt['tile'], timeouts=timeouts)
+                    )
+                    n_img += 1
+                    n_retried += bool(timeouts)
+                except BudgetExceeded as ex:
+                    print(f'{image_file}: {ex}')
+                    manifest.record(image_file, 'timeout', timeouts=ex.timeouts)
+                    n_timeout += 1
+                except Exception as e:
+                    print(e)
+                    manifest.record(image_file, 'failed', error=str(e))
+        finally:
+            writer.wait()
+            manifest.close()
+        _print_times(compute_time, writer.encode_time - encode_time0, n_img)
+        if n_retried:
+            print(f'{n_retried} images were retried with smaller tiles, their records hold the tile used')
+        if n_timeout:
+            print(f'WARNING: {n_timeout} images exceeded the time budget and have no output, see {manifest.record_dir}')
         
         return input_name
 
-    def _mod_img(self, image_file: str) -> np.array:
+    def _attempt_cost(self, attempt: Dict[str, Any], image_file: str) -> int:
+        """Network input pixels of _mod_img(image_file, **attempt)"""
+        with pil_image.open(image_file) as img:
+            W, H = img.size
+        tile = attempt['tile']
+        return inference_cost(
+            H, W, wind_size=W+10, stride=W+10, scale=3, padding=5,
+            tile=tile if tile < 1 else None
+        )
+
+    def _mod_img(self, image_file: str, tile: float = 1, deadline: Optional[float] = None) -> np.array:
+        """Super-resolve image_file with windows of a tile fraction of the LR width,
+        raising InferenceTimeout once deadline (time.time()) has passed"""
         
         zoom       = self.params["zoom"]
         loaded     = cv2.imread(image_file, -1)
-        wind_size  = loaded.shape[1]
         gpu_device = "0"
         res_output = 1/zoom # inria resolution
+        
+        # tile 1: the whole image in one window, which the deadline cannot interrupt
+        wind_size = loaded.shape[1]+10
 
         rec_img = process_file_msrn(
             loaded,
             self.model,
             compress=True,
             out_win = loaded.shape[-2],
-            wind_size=wind_size+10, stride=wind_size+10,
+            wind_size=wind_size, stride=wind_size,
             scale=3,
             batch_size=1,
-            padding=5
+            padding=5,
+            deadline=deadline,
+            tile=tile if tile < 1 else None
         )
         
         return rec_img
@@ -626,7 +1398,10 @@ class DSModifierESRGAN(DSModifier):
             model_fn      = params['model'],
             config_fn_lst = [],
             bucket_name   = "image-quality-framework",
-            algo          = "ESRGAN"
+            algo          = "ESRGAN",
+            engine        = params.get('engine'),
+            onnx          = params.get('onnx', False),
+            ort_threads   = params.get('ort_threads')
         )
         
         self.model , self.args = model_conf.load_ai_model_and_stuff()
@@ -641,19 +1416,42 @@ class DSModifierESRGAN(DSModifier):
         Returns:
             Name of the new folder containign the images
         """
+        if self.params.get('n_procs', 1) > 1:
+            return _run_local_shards(self, data_input, mod_path)
+        
         input_name = os.path.basename(data_input)
         dst = os.path.join(mod_path, input_name)
         os.makedirs(dst, exist_ok=True)
         
         print(f'For each image file in <{data_input}>...')
         
-        for image_file in glob( os.path.join(data_input,'*.tif') ):
+        writer = get_image_writer()
+        encode_time0, compute_time, n_img = writer.encode_time, 0.0, 0
+        image_files = glob( os.path.join(data_input,'*.tif') )
+        _setup_quantization(self, image_files)
+        manifest = _open_manifest(self, dst)
+        try:
+            for image_file in manifest.pending(_shard_files(image_files, self.params)):
             
-            imgp = self._mod_img( image_file )
-            print( imgp.shape )
-            cv2.imwrite( os.path.join(dst, os.path.basename(image_file)), imgp )
-        
-        print('Done.')
+                if not manifest.claim(image_file):
+                    continue
+            
+                t0 = time.time()
+                try:
+                    imgp = self._mod_img( image_file )
+                except Exception as e:
+                    manifest.record(image_file, 'failed', error=str(e))
+                    raise
+                compute_time += time.time() - t0
+                writer.submit(
+                    imgp, os.path.join(dst, os.path.basename(image_file)),
+                    on_done=manifest.on_written(image_file)
+                )
+                n_img += 1
+        finally:
+            writer.wait()
+            manifest.close()
+        _print_times(compute_time, writer.encode_time - encode_time0, n_img)
         
         return input_name
 
@@ -718,6 +1516,9 @@ class DSModifierFake(DSModifier):
         
     def _ds_input_modification(self, data_input: str, mod_path: str) -> str:
         
+        if self.params.get('n_procs', 1) > 1:
+            return _run_local_shards(self, data_input, mod_path)
+        
         input_name = os.path.basename(data_input)
         dst = os.path.join(mod_path, input_name)
         
@@ -725,12 +1526,31 @@ class DSModifierFake(DSModifier):
         
         print(f'For each image file in <{data_input}>...')
         
-        for image_file in glob( os.path.join(data_input,'*.'+self.src_ext) ):
+        writer = get_image_writer()
+        encode_time0, compute_time, n_img = writer.encode_time, 0.0, 0
+        manifest = _open_manifest(self, dst)
+        try:
+            for image_file in manifest.pending(_shard_files(glob( os.path.join(data_input,'*.'+self.src_ext) ), self.params)):
             
-            imgp = self._mod_img( image_file )
-            cv2.imwrite( os.path.join(dst, os.path.basename(image_file)), imgp )
-        
-        print('Done.')
+                if not manifest.claim(image_file):
+                    continue
+            
+                t0 = time.time()
+                try:
+                    imgp = self._mod_img( image_file )
+                except Exception as e:
+                    manifest.record(image_file, 'failed', error=str(e))
+                    raise
+                compute_time += time.time() - t0
+                writer.submit(
+                    imgp, os.path.join(dst, os.path.basename(image_file)),
+                    on_done=manifest.on_written(image_file)
+                )
+                n_img += 1
+        finally:
+            writer.wait()
+            manifest.close()
+        _print_times(compute_time, writer.encode_time - encode_time0, n_img)
         
         return input_name
 
@@ -794,6 +1614,18 @@ class SimilarityMetrics( Metric ):
 
         self.use_liif_loader      = use_liif_loader
     
+    @staticmethod
+    def drift(preds: List[Any], refs: List[Any]) -> Dict[str, float]:
+        """Mean ssim / psnr of model outputs preds against reference outputs refs
+        (e.g. quantized vs fp32), tensors (N,C,H,W) in [0,1]"""
+        ssim, psnr = [], []
+        for pred, ref in zip(preds, refs):
+            pred = torch.clamp( pred.float().cpu(), min=0.0, max=1.0 )
+            ref  = torch.clamp( ref.float().cpu() , min=0.0, max=1.0 )
+            ssim.append( piq.ssim(pred,ref).item() )
+            psnr.append( piq.psnr(pred,ref).item() )
+        return {"ssim": float(np.mean(ssim)), "psnr": float(np.mean(psnr))}
+    
     def _liff_loader_first_time(self,data_input:str) -> None:
     
         dsm_liif = DSModifierLIIF( params={
@@ -1,3 +1,4 @@
 from .datasets import register, make
 from . import image_folder
 from . import wrappers
+from . import batch_degradation
@@ -0,0 +1,182 @@
+import inspect
+import random
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+from datasets.liif.datasets import register
+from datasets.liif.wrappers import resize_fn
+from utils.utils_liif import make_coord
+
+_HAS_ANTIALIAS = 'antialias' in inspect.signature(F.interpolate).parameters
+
+
+@register('sr-implicit-hr-crop')
+class SRImplicitHRCrop(Dataset):
+    """ Only crops HR patches, the degradation runs after collation on the
+        training device with SRImplicitBatchDownsampler.
+        The crop is large enough for scale_max: round(inp_size * scale_max).
+        Takes the args of sr-implicit-downsampled, so a training config only
+        swaps the wrapper name; wrap its DataLoader in DegradedLoader.
+    """
+
+    def __init__(self, dataset, inp_size, scale_min=1, scale_max=None, augment=False, sample_q=None):
+        self.dataset = dataset
+        self.inp_size = inp_size
+        self.scale_min = scale_min
+        self.scale_max = scale_min if scale_max is None else scale_max
+        self.augment = augment
+        self.sample_q = sample_q
+        self.crop_size = round(inp_size * self.scale_max)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        img = self.dataset[idx]
+        x0 = random.randint(0, img.shape[-2] - self.crop_size)
+        y0 = random.randint(0, img.shape[-1] - self.crop_size)
+        return {'hr': img[:, x0: x0 + self.crop_size, y0: y0 + self.crop_size]}
+
+    def batch_degradation(self):
+        """ SRImplicitBatchDownsampler with the args of this wrapper. """
+        return SRImplicitBatchDownsampler(self.inp_size, self.scale_min, self.scale_max,
+                                          self.augment, self.sample_q)
+
+
+class DegradedLoader():
+    """ Iterates a DataLoader of sr-implicit-hr-crop batches, moves the HR
+        crops to device and yields them degraded by degradation
+        (by default the loader dataset's batch_degradation()):
+
+            loader = DegradedLoader(DataLoader(datasets.make(spec), ...), device='cuda')
+            for batch in loader:  # keys of sr-implicit-downsampled
+                ...
+    """
+
+    def __init__(self, loader, degradation=None, device='cuda'):
+        self.loader = loader
+        self.degradation = degradation or loader.dataset.batch_degradation()
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield self.degradation(batch['hr'].to(self.device, non_blocking=True))
+
+
+class SRImplicitBatchDownsampler():
+    """ Batched counterpart of sr-implicit-downsampled, run on the device of
+        the collated HR crops (see sr-implicit-hr-crop):
+        per-sample random scale, gaussian blur, bicubic resize, augmentation
+        and sampling of sample_q query pixels.
+        Blur kernels are cached per (kernel size, sigma, device); sigma is
+        rounded to 0.01 so that random scales hit the cache.
+        The resize matches resize_fn (PIL bicubic): antialiased, with the
+        input and output quantized to uint8 levels. torch versions without
+        F.interpolate(antialias=True) run resize_fn itself on the cpu.
+        If sample_q is None, one scale is drawn for the whole batch so that
+        the per-sample outputs can be stacked.
+    """
+
+    def __init__(self, inp_size, scale_min=1, scale_max=None, augment=False, sample_q=None):
+        self.inp_size = inp_size
+        self.scale_min = scale_min
+        if scale_max is None:
+            scale_max = scale_min
+        self.scale_max = scale_max
+        self.augment = augment
+        self.sample_q = sample_q
+        self._kernels = {}
+        self._coords = {}
+
+    def _get_kernel(self, s, device):
+        sigma = round(0.5 * s, 2)
+        kernel_size = int(sigma * 3 + 4)
+        if kernel_size % 2 == 0:
+            kernel_size += 1
+        key = (kernel_size, sigma, device)
+        if key not in self._kernels:
+            x = torch.arange(kernel_size, dtype=torch.float32, device=device) - kernel_size // 2
+            g = torch.exp(-x ** 2 / (2 * sigma ** 2))
+            g = g / g.sum()
+            self._kernels[key] = (g[:, None] * g[None, :]).expand(3, 1, kernel_size, kernel_size)
+        return self._kernels[key]
+
+    def _get_coord(self, h, w, device):
+        key = (h, w, device)
+        if key not in self._coords:
+            self._coords[key] = make_coord((h, w)).to(device)
+        return self._coords[key]
+
+    @staticmethod
+    def _resize(img, size):
+        """ resize_fn(img, size) on the device of img. """
+        if not _HAS_ANTIALIAS:
+            return resize_fn(img.cpu(), size).to(img.device)
+        # ToPILImage truncates to uint8, PIL rounds its output to uint8
+        img = img.clamp(0, 1).mul(255).floor_().div_(255)
+        out = F.interpolate(img[None], size=(size, size), mode='bicubic',
+                            align_corners=False, antialias=True)[0]
+        return out.clamp_(0, 1).mul_(255).round_().div_(255)
+
+    def _degrade(self, img, s):
+        """ img: Tensor, (3, H, W) HR crop on the target device. """
+        w_lr = self.inp_size
+        w_hr = round(w_lr * s)
+        x0 = random.randint(0, img.shape[-2] - w_hr)
+        y0 = random.randint(0, img.shape[-1] - w_hr)
+
+        kernel = self._get_kernel(s, img.device)
+        pad = kernel.shape[-1] // 2
+        blurred = F.conv2d(F.pad(img[None], (pad, pad, pad, pad), mode='reflect'), kernel, groups=3)
+        crop_hr = blurred[:, :, x0: x0 + w_hr, y0: y0 + w_hr]
+        crop_lr = self._resize(crop_hr[0], w_lr)
+        crop_hr = crop_hr[0]
+
+        if self.augment:
+            if random.random() < 0.5:
+                crop_lr, crop_hr = crop_lr.flip(-2), crop_hr.flip(-2)
+            if random.random() < 0.5:
+                crop_lr, crop_hr = crop_lr.flip(-1), crop_hr.flip(-1)
+            if random.random() < 0.5:
+                crop_lr, crop_hr = crop_lr.transpose(-2, -1), crop_hr.transpose(-2, -1)
+
+        hr_coord = self._get_coord(w_hr, w_hr, img.device)
+        hr_rgb = crop_hr.reshape(3, -1).permute(1, 0)
+        if self.sample_q is not None:
+            sample_lst = torch.randperm(len(hr_coord), device=img.device)[:self.sample_q]
+            hr_coord = hr_coord[sample_lst]
+            hr_rgb = hr_rgb[sample_lst]
+
+        cell = torch.ones_like(hr_coord)
+        cell[:, 0] *= 2 / w_hr
+        cell[:, 1] *= 2 / w_hr
+        return crop_lr, hr_coord, cell, hr_rgb, crop_hr
+
+    @torch.no_grad()
+    def __call__(self, hr):
+        """ hr: Tensor, (B, 3, H, W) collated HR crops.
+            Returns the same batch keys as sr-implicit-downsampled. 'gt2'
+            (the HR crops) is stacked when all samples share the scale,
+            otherwise it is a list of (3, h, w) tensors.
+        """
+        if self.sample_q is None:
+            scales = [random.uniform(self.scale_min, self.scale_max)] * hr.shape[0]
+        else:
+            scales = [random.uniform(self.scale_min, self.scale_max) for _ in range(hr.shape[0])]
+        samples = [self._degrade(img, s) for img, s in zip(hr, scales)]
+        inp, coord, cell, gt = [torch.stack(v) for v in list(zip(*samples))[:4]]
+        gt2 = [sample[4] for sample in samples]
+        if len(set(x.shape for x in gt2)) == 1:
+            gt2 = torch.stack(gt2)
+        return {
+            'inp': inp,
+            'coord': coord,
+            'cell': cell,
+            'gt': gt,
+            'gt2': gt2
+        }
@@ -26,6 +26,14 @@ class ImageFolder(Dataset):
                 filenames = json.load(f)[split_key]
         if first_k is not None:
             filenames = filenames[:first_k]
+        self.filenames = filenames
+
+        if cache == 'mmap':
+            self.mmap_file, index = self._pack_mmap(root_path, filenames)
+            self._mmap = None
+            self._mmap_pid = None
+            self.files = [index[filename] for filename in filenames]
+            return
 
         self.files = []
         for filename in filenames:
@@ -52,6 +60,53 @@ class ImageFolder(Dataset):
                 self.files.append(transforms.ToTensor()(
                     Image.open(file).convert('RGB')))
 
+    @staticmethod
+    def _pack_mmap(root_path, filenames):
+        """Decode the images once and pack them into one uint8 file.
+        All DataLoader workers memory-map the same file, so they share its
+        pages instead of each holding a copy of the dataset.
+        The pack is rebuilt when an image is missing from it or its file
+        size or mtime changed. Both files are written to temporary files and
+        moved in place, the index last, so an interrupted build is redone.
+        Returns the file path and the filename -> (offset, h, w) index.
+        """
+        mmap_root = os.path.join(os.path.dirname(root_path),
+                                 '_mmap_' + os.path.basename(root_path))
+        mmap_file = os.path.join(mmap_root, 'images.bin')
+        index_file = os.path.join(mmap_root, 'index.json')
+
+        def file_stat(filename):
+            stat = os.stat(os.path.join(root_path, filename))
+            return [stat.st_size, stat.st_mtime_ns]
+
+        if os.path.exists(index_file) and os.path.exists(mmap_file):
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+            if all(filename in index and index[filename][3:] == file_stat(filename)
+                   for filename in filenames):
+                return mmap_file, {k: tuple(v[:3]) for k, v in index.items()}
+
+        os.makedirs(mmap_root, exist_ok=True)
+        print('pack', mmap_file)
+        index = {}
+        offset = 0
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        with open(mmap_file + tmp_suffix, 'wb') as f:
+            for filename in filenames:
+                stat = file_stat(filename)
+                img = np.asarray(Image.open(os.path.join(root_path, filename)).convert('RGB'))
+                f.write(img.tobytes())
+                index[filename] = [offset, img.shape[0], img.shape[1]] + stat
+                offset += img.nbytes
+        with open(index_file + tmp_suffix, 'w') as f:
+            json.dump(index, f)
+        # the old index must not describe the new data
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        os.replace(mmap_file + tmp_suffix, mmap_file)
+        os.replace(index_file + tmp_suffix, index_file)
+        return mmap_file, {k: tuple(v[:3]) for k, v in index.items()}
+
     def __len__(self):
         return len(self.files) * self.repeat
 
@@ -74,6 +129,24 @@ class ImageFolder(Dataset):
         elif self.cache == 'in_memory':
             return x
 
+        elif self.cache == 'mmap':
+            # open lazily, once in each worker process
+            if self._mmap_pid != os.getpid():
+                self._mmap = np.memmap(self.mmap_file, dtype=np.uint8, mode='r')
+                self._mmap_pid = os.getpid()
+            offset, h, w = x
+            x = self._mmap[offset: offset + h * w * 3].reshape(h, w, 3)
+            x = np.ascontiguousarray(x.transpose(2, 0, 1), dtype=np.float32)
+            x = torch.from_numpy(x) / 255
+            return x
+
+    def __getstate__(self):
+        # spawned workers reopen the memory map instead of copying it
+        state = self.__dict__.copy()
+        if self.cache == 'mmap':
+            state.update(_mmap=None, _mmap_pid=None)
+        return state
+
 
 @register('paired-image-folders')
 class PairedImageFolders(Dataset):
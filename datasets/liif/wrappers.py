@@ -5,14 +5,13 @@ import math
 import kornia
 from PIL import Image
 
-import numpy as np
 import torch
 from torch.utils.data import Dataset
 from torchvision import transforms
 from torchvision.utils import save_image
 
 from datasets.liif.datasets import register
-from utils.utils_liif import to_pixel_samples
+from utils.utils_liif import to_pixel_samples, sample_pixel_samples
 
 @register('sr-implicit-paired')
 class SRImplicitPaired(Dataset):
@@ -61,13 +60,10 @@ class SRImplicitPaired(Dataset):
             crop_lr = augment(crop_lr)
             crop_hr = augment(crop_hr)
 
-        hr_coord, hr_rgb = to_pixel_samples(crop_hr.contiguous())
-
         if self.sample_q is not None:
-            sample_lst = np.random.choice(
-                len(hr_coord), self.sample_q, replace=False)
-            hr_coord = hr_coord[sample_lst]
-            hr_rgb = hr_rgb[sample_lst]
+            hr_coord, hr_rgb = sample_pixel_samples(crop_hr, self.sample_q)
+        else:
+            hr_coord, hr_rgb = to_pixel_samples(crop_hr.contiguous())
 
         cell = torch.ones_like(hr_coord)
         cell[:, 0] *= 2 / crop_hr.shape[-2]
@@ -162,13 +158,10 @@ class SRImplicitDownsampled(Dataset):
             crop_lr = augment(crop_lr)
             crop_hr = augment(crop_hr)
 
-        hr_coord, hr_rgb = to_pixel_samples(crop_hr.contiguous())
-
         if self.sample_q is not None:
-            sample_lst = np.random.choice(
-                len(hr_coord), self.sample_q, replace=False)
-            hr_coord = hr_coord[sample_lst]
-            hr_rgb = hr_rgb[sample_lst]
+            hr_coord, hr_rgb = sample_pixel_samples(crop_hr, self.sample_q)
+        else:
+            hr_coord, hr_rgb = to_pixel_samples(crop_hr.contiguous())
 
         cell = torch.ones_like(hr_coord)
         cell[:, 0] *= 2 / crop_hr.shape[-2]
@@ -214,13 +207,10 @@ class SRImplicitUniformVaried(Dataset):
         if self.gt_resize is not None:
             img_hr = resize_fn(img_hr, self.gt_resize)
 
-        hr_coord, hr_rgb = to_pixel_samples(img_hr)
-
         if self.sample_q is not None:
-            sample_lst = np.random.choice(
-                len(hr_coord), self.sample_q, replace=False)
-            hr_coord = hr_coord[sample_lst]
-            hr_rgb = hr_rgb[sample_lst]
+            hr_coord, hr_rgb = sample_pixel_samples(img_hr, self.sample_q)
+        else:
+            hr_coord, hr_rgb = to_pixel_samples(img_hr)
 
         cell = torch.ones_like(hr_coord)
         cell[:, 0] *= 2 / img_hr.shape[-2]
@@ -1,5 +1,7 @@
+import hashlib
 import math
 import torch
+from collections import OrderedDict
 from torch import autograd as autograd
 from torch import nn as nn
 from torch.nn import functional as F
@@ -157,6 +159,17 @@ class PerceptualLoss(nn.Module):
             calculated and the loss will multiplied by the weight.
             Default: 0.
         criterion (str): Criterion used for perceptual loss. Default: 'l1'.
+        gt_cache_size (float): Memory budget (in MB) of the GT feature cache.
+            GT features are cached per sample when ``forward`` receives
+            ``gt_keys``, which must identify both the sample and its
+            augmentation. Datasets may provide them as ``gt_key``, otherwise
+            SRModel uses ``gt_content_keys`` (a hash of the gt pixels), so
+            only repeated crops (e.g. sub-images of gt_size without random
+            cropping) hit the cache.
+            Least recently used entries are evicted first. 0 disables the
+            cache. Default: 0.
+        channels_last (bool): If True, run vgg in channels-last memory format.
+            Default: False.
     """
 
     def __init__(self,
@@ -166,8 +179,13 @@ class PerceptualLoss(nn.Module):
                  range_norm=False,
                  perceptual_weight=1.0,
                  style_weight=0.,
-                 criterion='l1'):
+                 criterion='l1',
+                 gt_cache_size=0,
+                 channels_last=False):
         super(PerceptualLoss, self).__init__()
+        self.gt_cache_size = int(gt_cache_size * 1024**2)
+        self._gt_cache = OrderedDict()
+        self._gt_cache_bytes = 0
         self.perceptual_weight = perceptual_weight
         self.style_weight = style_weight
         self.layer_weights = layer_weights
@@ -175,7 +193,8 @@ class PerceptualLoss(nn.Module):
             layer_name_list=list(layer_weights.keys()),
             vgg_type=vgg_type,
             use_input_norm=use_input_norm,
-            range_norm=range_norm)
+            range_norm=range_norm,
+            channels_last=channels_last)
 
         self.criterion_type = criterion
         if self.criterion_type == 'l1':
@@ -187,17 +206,19 @@ class PerceptualLoss(nn.Module):
         else:
             raise NotImplementedError(f'{criterion} criterion has not been supported.')
 
-    def forward(self, x, gt):
+    def forward(self, x, gt, gt_keys=None):
         """Forward function.
         Args:
             x (Tensor): Input tensor with shape (n, c, h, w).
             gt (Tensor): Ground-truth tensor with shape (n, c, h, w).
+            gt_keys (list[str], optional): Cache key of each gt sample. If
+                None, gt features are not cached. Default: None.
         Returns:
             Tensor: Forward results.
         """
         # extract vgg features
         x_features = self.vgg(x)
-        gt_features = self.vgg(gt.detach())
+        gt_features = self._get_gt_features(gt, gt_keys)
 
         # calculate perceptual loss
         if self.perceptual_weight > 0:
@@ -227,6 +248,54 @@ class PerceptualLoss(nn.Module):
 
         return percep_loss, style_loss
 
+    @staticmethod
+    def gt_content_keys(gt):
+        """Cache key of each gt sample: sha1 of its pixels, so the same crop
+        with the same flip/rot always gets the same key.
+        Args:
+            gt (Tensor): Ground-truth tensor with shape (n, c, h, w).
+        Returns:
+            list[str]: Key of each sample.
+        """
+        gt = gt.detach().cpu().contiguous().numpy()
+        return [hashlib.sha1(sample.tobytes()).hexdigest() for sample in gt]
+
+    def _get_gt_features(self, gt, gt_keys=None):
+        """Extract gt vgg features, without building the backward graph.
+        Args:
+            gt (Tensor): Ground-truth tensor with shape (n, c, h, w).
+            gt_keys (list[str], optional): Cache key of each gt sample.
+        Returns:
+            dict[str, Tensor]: gt features of each layer.
+        """
+        if self.gt_cache_size <= 0 or gt_keys is None:
+            return self.vgg.forward_gt(gt)
+
+        cached = [self._gt_cache.get(key) for key in gt_keys]
+        missing = [i for i, feat in enumerate(cached) if feat is None]
+        if missing:
+            features = self.vgg.forward_gt(gt[missing])
+            for j, i in enumerate(missing):
+                # clone, so that a cached sample does not keep the whole batch alive
+                cached[i] = {k: v[j].clone() for k, v in features.items()}
+                self._put_gt_cache(gt_keys[i], cached[i])
+        for key in gt_keys:
+            if key in self._gt_cache:
+                self._gt_cache.move_to_end(key)
+
+        return {k: torch.stack([feat[k] for feat in cached]) for k in cached[0].keys()}
+
+    def _put_gt_cache(self, key, feat):
+        """Add the features of one sample and evict the LRU ones over budget."""
+        nbytes = sum(v.numel() * v.element_size() for v in feat.values())
+        if nbytes > self.gt_cache_size or key in self._gt_cache:
+            return
+        self._gt_cache[key] = feat
+        self._gt_cache_bytes += nbytes
+        while self._gt_cache_bytes > self.gt_cache_size:
+            _, old_feat = self._gt_cache.popitem(last=False)
+            self._gt_cache_bytes -= sum(v.numel() * v.element_size() for v in old_feat.values())
+
     def _gram_mat(self, x):
         """Calculate Gram matrix.
         Args:
@@ -37,4 +37,17 @@ def to_y_channel(img):
     if img.ndim == 3 and img.shape[2] == 3:
         img = bgr2ycbcr(img, y_only=True)
         img = img[..., None]
-    return img * 255.
\ No newline at end of file
+    return img * 255.
+
+def to_y_channel_pt(img):
+    """Change to Y channel of YCbCr for tensors.
+    It matches :func:`to_y_channel`, but works on RGB tensors in [0, 1].
+    Args:
+        img (Tensor): Images with shape (n, 3, h, w) and range [0, 1].
+    Returns:
+        (Tensor): Images with shape (n, 1, h, w) and range [0, 1] without round.
+    """
+    if img.size(1) == 3:
+        weight = img.new_tensor([65.481, 128.553, 24.966]).view(1, 3, 1, 1)
+        img = ((img * weight).sum(dim=1, keepdim=True) + 16.0) / 255.
+    return img
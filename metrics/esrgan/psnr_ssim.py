@@ -1,7 +1,9 @@
 import cv2
 import numpy as np
+import torch
+from torch.nn import functional as F
 
-from metrics.esrgan.metric_util import reorder_image, to_y_channel
+from metrics.esrgan.metric_util import reorder_image, to_y_channel, to_y_channel_pt
 from utils.esrgan.registry import METRIC_REGISTRY
 
 
@@ -114,4 +116,98 @@ def calculate_ssim(img1, img2, crop_border, input_order='HWC', test_y_channel=Fa
     ssims = []
     for i in range(img1.shape[2]):
         ssims.append(_ssim(img1[..., i], img2[..., i]))
-    return np.array(ssims).mean()
\ No newline at end of file
+    return np.array(ssims).mean()
+
+
+@METRIC_REGISTRY.register()
+def calculate_psnr_pt(img1, img2, crop_border, test_y_channel=False, **kwargs):
+    """Calculate PSNR (Peak Signal-to-Noise Ratio) on tensors.
+    It skips the uint8 round-trip of :func:`calculate_psnr`, so the whole
+    batch is evaluated at once on the device where it lives.
+    Args:
+        img1 (Tensor): Images with shape (n, c, h, w), RGB order and range [0, 1].
+        img2 (Tensor): Images with shape (n, c, h, w), RGB order and range [0, 1].
+        crop_border (int): Cropped pixels in each edge of an image. These
+            pixels are not involved in the PSNR calculation.
+        test_y_channel (bool): Test on Y channel of YCbCr. Default: False.
+    Returns:
+        Tensor: psnr result for each image, with shape (n, ).
+    """
+
+    assert img1.shape == img2.shape, (f'Image shapes are differnet: {img1.shape}, {img2.shape}.')
+
+    if crop_border != 0:
+        img1 = img1[:, :, crop_border:-crop_border, crop_border:-crop_border]
+        img2 = img2[:, :, crop_border:-crop_border, crop_border:-crop_border]
+
+    if test_y_channel:
+        img1 = to_y_channel_pt(img1)
+        img2 = to_y_channel_pt(img2)
+
+    img1 = img1.to(torch.float64)
+    img2 = img2.to(torch.float64)
+
+    mse = torch.mean((img1 - img2)**2, dim=[1, 2, 3])
+    return 10. * torch.log10(1. / (mse + 1e-8))
+
+
+def _ssim_pt(img1, img2):
+    """Calculate SSIM (structural similarity) on tensors.
+    It is called by func:`calculate_ssim_pt`.
+    Args:
+        img1 (Tensor): Images with range [0, 255] with shape (n, c, h, w).
+        img2 (Tensor): Images with range [0, 255] with shape (n, c, h, w).
+    Returns:
+        Tensor: ssim result for each image, with shape (n, ).
+    """
+
+    C1 = (0.01 * 255)**2
+    C2 = (0.03 * 255)**2
+
+    kernel = cv2.getGaussianKernel(11, 1.5)
+    window = torch.from_numpy(np.outer(kernel, kernel.transpose())).to(img1)
+    window = window.view(1, 1, 11, 11).expand(img1.size(1), 1, 11, 11)
+
+    # 'valid' convolution, same as cropping 5 pixels of cv2.filter2D output
+    mu1 = F.conv2d(img1, window, groups=img1.size(1))
+    mu2 = F.conv2d(img2, window, groups=img2.size(1))
+    mu1_sq = mu1**2
+    mu2_sq = mu2**2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = F.conv2d(img1 * img1, window, groups=img1.size(1)) - mu1_sq
+    sigma2_sq = F.conv2d(img2 * img2, window, groups=img2.size(1)) - mu2_sq
+    sigma12 = F.conv2d(img1 * img2, window, groups=img1.size(1)) - mu1_mu2
+
+    ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2))
+    return ssim_map.mean([1, 2, 3])
+
+
+@METRIC_REGISTRY.register()
+def calculate_ssim_pt(img1, img2, crop_border, test_y_channel=False, **kwargs):
+    """Calculate SSIM (structural similarity) on tensors.
+    Tensor counterpart of :func:`calculate_ssim`. For three-channel images,
+    SSIM is calculated for each channel and then averaged.
+    Args:
+        img1 (Tensor): Images with shape (n, c, h, w), RGB order and range [0, 1].
+        img2 (Tensor): Images with shape (n, c, h, w), RGB order and range [0, 1].
+        crop_border (int): Cropped pixels in each edge of an image. These
+            pixels are not involved in the SSIM calculation.
+        test_y_channel (bool): Test on Y channel of YCbCr. Default: False.
+    Returns:
+        Tensor: ssim result for each image, with shape (n, ).
+    """
+
+    assert img1.shape == img2.shape, (f'Image shapes are differnet: {img1.shape}, {img2.shape}.')
+
+    if crop_border != 0:
+        img1 = img1[:, :, crop_border:-crop_border, crop_border:-crop_border]
+        img2 = img2[:, :, crop_border:-crop_border, crop_border:-crop_border]
+
+    if test_y_channel:
+        img1 = to_y_channel_pt(img1)
+        img2 = to_y_channel_pt(img2)
+
+    img1 = img1.to(torch.float64) * 255.
+    img2 = img2.to(torch.float64) * 255.
+
+    return _ssim_pt(img1, img2)
@@ -0,0 +1,24 @@
+import numpy as np
+import torch
+
+from metrics.esrgan import calculate_psnr, calculate_psnr_pt
+
+
+def test_psnr_pt():
+    """calculate_psnr_pt on a batch matches calculate_psnr on each image."""
+    rng = np.random.RandomState(0)
+    gt = rng.randint(0, 256, size=(2, 3, 16, 20)).astype(np.uint8)
+    noise = rng.randint(-20, 21, size=gt.shape)
+    img = np.clip(gt.astype(np.int64) + noise, 0, 255).astype(np.uint8)
+
+    for crop_border in [0, 2]:
+        for test_y_channel in [False, True]:
+            psnr_pt = calculate_psnr_pt(
+                torch.from_numpy(img).float() / 255., torch.from_numpy(gt).float() / 255.,
+                crop_border=crop_border, test_y_channel=test_y_channel)
+            for i in range(len(gt)):
+                # calculate_psnr takes BGR HWC images
+                psnr = calculate_psnr(
+                    img[i].transpose(1, 2, 0)[..., ::-1], gt[i].transpose(1, 2, 0)[..., ::-1],
+                    crop_border=crop_border, test_y_channel=test_y_channel)
+                assert abs(psnr_pt[i].item() - psnr) < 1e-3, (crop_border, test_y_channel, psnr_pt[i].item(), psnr)
@@ -6,6 +6,7 @@ from copy import deepcopy
 from torch.nn.parallel import DataParallel, DistributedDataParallel
 
 from models.esrgan import lr_scheduler as lr_scheduler
+from utils.esrgan.checkpoint_saver import CheckpointSaver
 from utils.esrgan.dist_util import master_only
 
 logger = logging.getLogger('basicsr')
@@ -20,6 +21,11 @@ class BaseModel():
         self.is_train = opt['is_train']
         self.schedulers = []
         self.optimizers = []
+        # checkpoints are snapshotted to CPU and, with logger.async_save,
+        # written by a background thread
+        logger_opt = opt.get('logger', {})
+        self.ckpt_saver = CheckpointSaver(
+            async_mode=logger_opt.get('async_save', False), max_keep=logger_opt.get('max_keep_ckpts', None))
 
     def feed_data(self, data):
         print('Aqui entra i fa algu?')
@@ -42,6 +48,8 @@ class BaseModel():
             tb_logger (tensorboard logger): Tensorboard logger.
             save_img (bool): Whether to save images. Default: False.
         """
+        # validation may read back the checkpoints saved just before it
+        self.wait_for_saving()
         if self.opt['dist']:
             self.dist_validation(dataloader, current_iter, tb_logger, save_img)
         else:
@@ -185,14 +193,15 @@ class BaseModel():
         save_dict = {}
         for net_, param_key_ in zip(net, param_key):
             net_ = self.get_bare_model(net_)
-            state_dict = net_.state_dict()
-            for key, param in state_dict.items():
+            state_dict = OrderedDict()
+            for key, param in net_.state_dict().items():
                 if key.startswith('module.'):  # remove unnecessary 'module.'
                     key = key[7:]
-                state_dict[key] = param.cpu()
+                state_dict[key] = param
             save_dict[param_key_] = state_dict
 
-        torch.save(save_dict, save_path)
+        # the saver copies the tensors to CPU before returning
+        self.ckpt_saver.save(save_dict, save_path)
 
     def _print_different_keys_loading(self, crt_net, load_net, strict=True):
         """Print keys with differnet name or different size when loading models.
@@ -237,6 +246,7 @@ class BaseModel():
                 Default: 'params'.
         """
         net = self.get_bare_model(net)
+        self.wait_for_saving()
         logger.info(f'Loading {net.__class__.__name__} model from {load_path}.')
         load_net = torch.load(load_path, map_location=lambda storage, loc: storage)
         if param_key is not None:
@@ -268,13 +278,21 @@ class BaseModel():
                 state['schedulers'].append(s.state_dict())
             save_filename = f'{current_iter}.state'
             save_path = os.path.join(self.opt['path']['training_states'], save_filename)
-            torch.save(state, save_path)
+            self.ckpt_saver.save(state, save_path)
+
+    def wait_for_saving(self):
+        """Block until all the pending checkpoints are written to disk.
+        Called before checkpoints are read back (validation, loading,
+        resuming) and by ``save`` at the end of training.
+        """
+        self.ckpt_saver.wait()
 
     def resume_training(self, resume_state):
         """Reload the optimizers and schedulers for resumed training.
         Args:
             resume_state (dict): Resume state.
         """
+        self.wait_for_saving()
         resume_optimizers = resume_state['optimizers']
         resume_schedulers = resume_state['schedulers']
         assert len(resume_optimizers) == len(self.optimizers), 'Wrong lengths of optimizers'
@@ -296,7 +314,8 @@ class BaseModel():
                 losses = []
                 for name, value in loss_dict.items():
                     keys.append(name)
-                    losses.append(value)
+                    # losses computed under autocast may have different dtypes
+                    losses.append(value.float())
                 losses = torch.stack(losses, 0)
                 torch.distributed.reduce(losses, dst=0)
                 if self.opt['rank'] == 0:
@@ -16,37 +16,39 @@ class ESRGANModel(SRGANModel):
             p.requires_grad = False
 
         self.optimizer_g.zero_grad()
-        self.output = self.net_g(self.lq)
+        with self.autocast():
+            self.output = self.net_g(self.lq)
 
         l_g_total = 0
         loss_dict = OrderedDict()
         if (current_iter % self.net_d_iters == 0 and current_iter > self.net_d_init_iters):
-            # pixel loss
-            if self.cri_pix:
-                l_g_pix = self.cri_pix(self.output, self.gt)
-                l_g_total += l_g_pix
-                loss_dict['l_g_pix'] = l_g_pix
-            # perceptual loss
-            if self.cri_perceptual:
-                l_g_percep, l_g_style = self.cri_perceptual(self.output, self.gt)
-                if l_g_percep is not None:
-                    l_g_total += l_g_percep
-                    loss_dict['l_g_percep'] = l_g_percep
-                if l_g_style is not None:
-                    l_g_total += l_g_style
-                    loss_dict['l_g_style'] = l_g_style
-            # gan loss (relativistic gan)
-            real_d_pred = self.net_d(self.gt).detach()
-            fake_g_pred = self.net_d(self.output)
-            l_g_real = self.cri_gan(real_d_pred - torch.mean(fake_g_pred), False, is_disc=False)
-            l_g_fake = self.cri_gan(fake_g_pred - torch.mean(real_d_pred), True, is_disc=False)
-            l_g_gan = (l_g_real + l_g_fake) / 2
+            with self.autocast():
+                # pixel loss
+                if self.cri_pix:
+                    l_g_pix = self.cri_pix(self.output.float(), self.gt)
+                    l_g_total += l_g_pix
+                    loss_dict['l_g_pix'] = l_g_pix
+                # perceptual loss
+                if self.cri_perceptual:
+                    l_g_percep, l_g_style = self.cri_perceptual(self.output, self.gt, gt_keys=self._perceptual_gt_keys())
+                    if l_g_percep is not None:
+                        l_g_total += l_g_percep
+                        loss_dict['l_g_percep'] = l_g_percep
+                    if l_g_style is not None:
+                        l_g_total += l_g_style
+                        loss_dict['l_g_style'] = l_g_style
+                # gan loss (relativistic gan)
+                real_d_pred = self.net_d(self.gt).detach()
+                fake_g_pred = self.net_d(self.output)
+                l_g_real = self.cri_gan(real_d_pred - torch.mean(fake_g_pred), False, is_disc=False)
+                l_g_fake = self.cri_gan(fake_g_pred - torch.mean(real_d_pred), True, is_disc=False)
+                l_g_gan = (l_g_real + l_g_fake) / 2
 
-            l_g_total += l_g_gan
-            loss_dict['l_g_gan'] = l_g_gan
+                l_g_total += l_g_gan
+                loss_dict['l_g_gan'] = l_g_gan
 
-            l_g_total.backward()
-            self.optimizer_g.step()
+            self.grad_scaler.scale(l_g_total).backward()
+            self.grad_scaler.step(self.optimizer_g)
 
         # optimize net_d
         for p in self.net_d.parameters():
@@ -63,15 +65,18 @@ class ESRGANModel(SRGANModel):
         # tensor for calculating mean.
 
         # real
-        fake_d_pred = self.net_d(self.output).detach()
-        real_d_pred = self.net_d(self.gt)
-        l_d_real = self.cri_gan(real_d_pred - torch.mean(fake_d_pred), True, is_disc=True) * 0.5
-        l_d_real.backward()
+        with self.autocast():
+            fake_d_pred = self.net_d(self.output).detach()
+            real_d_pred = self.net_d(self.gt)
+            l_d_real = self.cri_gan(real_d_pred - torch.mean(fake_d_pred), True, is_disc=True) * 0.5
+        self.grad_scaler.scale(l_d_real).backward()
         # fake
-        fake_d_pred = self.net_d(self.output.detach())
-        l_d_fake = self.cri_gan(fake_d_pred - torch.mean(real_d_pred.detach()), False, is_disc=True) * 0.5
-        l_d_fake.backward()
-        self.optimizer_d.step()
+        with self.autocast():
+            fake_d_pred = self.net_d(self.output.detach())
+            l_d_fake = self.cri_gan(fake_d_pred - torch.mean(real_d_pred.detach()), False, is_disc=True) * 0.5
+        self.grad_scaler.scale(l_d_fake).backward()
+        self.grad_scaler.step(self.optimizer_d)
+        self.grad_scaler.update()
 
         loss_dict['l_d_real'] = l_d_real
         loss_dict['l_d_fake'] = l_d_fake
@@ -81,4 +86,4 @@ class ESRGANModel(SRGANModel):
         self.log_dict = self.reduce_loss_dict(loss_dict)
 
         if self.ema_decay > 0:
-            self.model_ema(decay=self.ema_decay)
\ No newline at end of file
+            self.model_ema(decay=self.ema_decay)
@@ -1,5 +1,8 @@
+import contextlib
 import torch
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from os import path as osp
 from tqdm import tqdm
 
@@ -7,7 +10,7 @@ from archs.esrgan import build_network
 from losses.esrgan import build_loss
 from metrics.esrgan import calculate_metric
 from utils.esrgan import get_root_logger, imwrite, tensor2img
-from utils.esrgan.registry import MODEL_REGISTRY
+from utils.esrgan.registry import METRIC_REGISTRY, MODEL_REGISTRY
 from .base_model import BaseModel
 
 
@@ -68,6 +71,35 @@ class SRModel(BaseModel):
         # set up optimizers and schedulers
         self.setup_optimizers()
         self.setup_schedulers()
+        self.setup_amp()
+
+    def setup_amp(self):
+        """Set up mixed precision training from the ``train.amp`` options.
+        Options:
+            enabled (bool): Run forward passes and losses under autocast.
+                Default: False.
+            dtype (str): Autocast dtype, 'bfloat16' or 'float16'. Default:
+                'bfloat16'. float16 uses loss scaling and needs a GPU.
+        """
+        amp_opt = self.opt['train'].get('amp', {})
+        self.use_amp = amp_opt.get('enabled', False)
+        self.amp_dtype = getattr(torch, amp_opt.get('dtype', 'bfloat16'))
+        if self.use_amp:
+            if not hasattr(torch, 'autocast'):
+                raise NotImplementedError('Autocast training needs PyTorch >= 1.10.')
+            if self.amp_dtype == torch.float16 and self.device.type != 'cuda':
+                raise NotImplementedError('float16 autocast is only supported on GPU, use bfloat16 instead.')
+            logger = get_root_logger()
+            logger.info(f'Use autocast with {self.amp_dtype} on {self.device.type}.')
+        # float16 gradients may underflow, bfloat16 has the same range as float32
+        use_scaler = self.use_amp and self.amp_dtype == torch.float16
+        self.grad_scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+
+    def autocast(self):
+        """Context for forward passes and losses in optimize_parameters."""
+        if self.use_amp:
+            return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype)
+        return contextlib.ExitStack()
 
     def setup_optimizers(self):
         train_opt = self.opt['train']
@@ -87,31 +119,44 @@ class SRModel(BaseModel):
         self.lq = data['lq'].to(self.device)
         if 'gt' in data:
             self.gt = data['gt'].to(self.device)
-
+        # keys of the perceptual-loss gt feature cache: 'gt_key' of the dataset
+        # (sample id and augmentation) if any, otherwise a hash of the gt
+        # pixels, computed by _perceptual_gt_keys in the training path only
+        self.gt_keys = data.get('gt_key')
+        self._gt_cpu = data.get('gt')
+
+    def _perceptual_gt_keys(self):
+        """Keys of the perceptual-loss gt feature cache for the current batch."""
+        if (self.gt_keys is None and self._gt_cpu is not None
+                and self.cri_perceptual.gt_cache_size > 0):
+            self.gt_keys = self.cri_perceptual.gt_content_keys(self._gt_cpu)
+        return self.gt_keys
 
     def optimize_parameters(self, current_iter):
         self.optimizer_g.zero_grad()
-        self.output = self.net_g(self.lq)
-
-        l_total = 0
-        loss_dict = OrderedDict()
-        # pixel loss
-        if self.cri_pix:
-            l_pix = self.cri_pix(self.output, self.gt)
-            l_total += l_pix
-            loss_dict['l_pix'] = l_pix
-        # perceptual loss
-        if self.cri_perceptual:
-            l_percep, l_style = self.cri_perceptual(self.output, self.gt)
-            if l_percep is not None:
-                l_total += l_percep
-                loss_dict['l_percep'] = l_percep
-            if l_style is not None:
-                l_total += l_style
-                loss_dict['l_style'] = l_style
-
-        l_total.backward()
-        self.optimizer_g.step()
+        with self.autocast():
+            self.output = self.net_g(self.lq)
+
+            l_total = 0
+            loss_dict = OrderedDict()
+            # pixel loss
+            if self.cri_pix:
+                l_pix = self.cri_pix(self.output.float(), self.gt)
+                l_total += l_pix
+                loss_dict['l_pix'] = l_pix
+            # perceptual loss
+            if self.cri_perceptual:
+                l_percep, l_style = self.cri_perceptual(self.output, self.gt, gt_keys=self._perceptual_gt_keys())
+                if l_percep is not None:
+                    l_total += l_percep
+                    loss_dict['l_percep'] = l_percep
+                if l_style is not None:
+                    l_total += l_style
+                    loss_dict['l_style'] = l_style
+
+        self.grad_scaler.scale(l_total).backward()
+        self.grad_scaler.step(self.optimizer_g)
+        self.grad_scaler.update()
 
         self.log_dict = self.reduce_loss_dict(loss_dict)
 
@@ -134,58 +179,134 @@ class SRModel(BaseModel):
             self.nondist_validation(dataloader, current_iter, tb_logger, save_img)
 
     def nondist_validation(self, dataloader, current_iter, tb_logger, save_img):
+        """Validation on a single process.
+        Samples with the same spatial size are grouped into batches of
+        ``val.batch_size`` images (default: 1) before running the network.
+        With ``val.pt_metrics`` (default: False), metrics that have a
+        registered ``<type>_pt`` variant are computed on the float output
+        tensors of the whole batch; the others still run per image on the
+        quantized uint8 images. Note that the ``_pt`` variants skip the uint8
+        quantization, so their values differ slightly from the default ones.
+        Images are written by ``val.num_save_workers`` background threads.
+        """
         dataset_name = dataloader.dataset.opt['name']
-        with_metrics = self.opt['val'].get('metrics') is not None
+        val_opt = self.opt['val']
+        batch_size = val_opt.get('batch_size', 1)
+        use_pt_metrics = val_opt.get('pt_metrics', False)
+        with_metrics = val_opt.get('metrics') is not None
+        metric_opts, pt_metric_opts = {}, {}
         if with_metrics:
-            self.metric_results = {metric: 0 for metric in self.opt['val']['metrics'].keys()}
+            self.metric_results = {metric: 0 for metric in val_opt['metrics'].keys()}
+            for name, opt_ in deepcopy(val_opt['metrics']).items():
+                if use_pt_metrics and f"{opt_['type']}_pt" in METRIC_REGISTRY:
+                    opt_['type'] = f"{opt_['type']}_pt"
+                    pt_metric_opts[name] = opt_
+                else:
+                    metric_opts[name] = opt_
         pbar = tqdm(total=len(dataloader), unit='image')
+        save_pool = ThreadPoolExecutor(max_workers=val_opt.get('num_save_workers', 2)) if save_img else None
+        save_jobs = []
 
-        for idx, val_data in enumerate(dataloader):
-            img_name = osp.splitext(osp.basename(val_data['lq_path'][0]))[0]
+        num_img = 0
+        for val_data in self._get_val_batches(dataloader, batch_size):
+            img_names = [osp.splitext(osp.basename(path))[0] for path in val_data['lq_path']]
             self.feed_data(val_data)
             self.test()
 
             visuals = self.get_current_visuals()
-            sr_img = tensor2img([visuals['result']])
-            if 'gt' in visuals:
-                gt_img = tensor2img([visuals['gt']])
-                del self.gt
+            if pt_metric_opts:
+                # calculate metrics for the whole batch
+                metric_data = dict(img1=self.output.detach().clamp(0, 1), img2=self.gt.clamp(0, 1))
+                for name, opt_ in pt_metric_opts.items():
+                    self.metric_results[name] += calculate_metric(metric_data, opt_).sum().item()
+
+            for i, img_name in enumerate(img_names):
+                if save_img:
+                    if self.opt['is_train']:
+                        save_img_path = osp.join(self.opt['path']['visualization'], img_name,
+                                                 f'{img_name}_{current_iter}.png')
+                    else:
+                        if val_opt['suffix']:
+                            save_img_path = osp.join(self.opt['path']['visualization'], dataset_name,
+                                                     f'{img_name}_{val_opt["suffix"]}.png')
+                        else:
+                            save_img_path = osp.join(self.opt['path']['visualization'], dataset_name,
+                                                     f'{img_name}_{self.opt["name"]}.png')
+                    save_jobs.append(save_pool.submit(self._save_val_image, visuals['result'][i:i + 1],
+                                                      save_img_path))
+
+                if metric_opts:
+                    # calculate metrics
+                    sr_img = tensor2img([visuals['result'][i:i + 1]])
+                    gt_img = tensor2img([visuals['gt'][i:i + 1]])
+                    for name, opt_ in metric_opts.items():
+                        metric_data = dict(img1=sr_img, img2=gt_img)
+                        self.metric_results[name] += calculate_metric(metric_data, opt_)
+                pbar.update(1)
+                pbar.set_description(f'Test {img_name}')
+            num_img += len(img_names)
 
-            # tentative for out of GPU memory
             del self.lq
             del self.output
-            torch.cuda.empty_cache()
-
-            if save_img:
-                if self.opt['is_train']:
-                    save_img_path = osp.join(self.opt['path']['visualization'], img_name,
-                                             f'{img_name}_{current_iter}.png')
-                else:
-                    if self.opt['val']['suffix']:
-                        save_img_path = osp.join(self.opt['path']['visualization'], dataset_name,
-                                                 f'{img_name}_{self.opt["val"]["suffix"]}.png')
-                    else:
-                        save_img_path = osp.join(self.opt['path']['visualization'], dataset_name,
-                                                 f'{img_name}_{self.opt["name"]}.png')
-                imwrite(sr_img, save_img_path)
-
-            if with_metrics:
-                # calculate metrics
-                for name, opt_ in self.opt['val']['metrics'].items():
-                    metric_data = dict(img1=sr_img, img2=gt_img)
-                    print(sr_img.shape)
-                    print(gt_img.shape)
-                    self.metric_results[name] += calculate_metric(metric_data, opt_)
-            pbar.update(1)
-            pbar.set_description(f'Test {img_name}')
+            if hasattr(self, 'gt'):
+                del self.gt
         pbar.close()
 
+        if save_img:
+            for job in save_jobs:
+                job.result()
+            save_pool.shutdown()
+        # tentative for out of GPU memory
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
         if with_metrics:
             for metric in self.metric_results.keys():
-                self.metric_results[metric] /= (idx + 1)
+                self.metric_results[metric] /= num_img
 
             self._log_validation_metric_values(current_iter, dataset_name, tb_logger)
 
+    def _get_val_batches(self, dataloader, batch_size):
+        """Group consecutive validation samples into batches.
+        Only samples whose lq (and gt) tensors have the same shape are
+        concatenated, so validation sets with mixed image sizes still work.
+        Args:
+            dataloader (torch.utils.data.DataLoader): Validation dataloader.
+            batch_size (int): Maximum number of images in a batch.
+        Yields:
+            dict: Batched data with 'lq', 'lq_path' and optionally 'gt'.
+        """
+
+        def _collate(buffer):
+            data = {
+                'lq': torch.cat([v['lq'] for v in buffer], 0),
+                'lq_path': [path for v in buffer for path in v['lq_path']]
+            }
+            if 'gt' in buffer[0]:
+                data['gt'] = torch.cat([v['gt'] for v in buffer], 0)
+            return data
+
+        def _shape(data):
+            return data['lq'].shape[1:], data['gt'].shape[1:] if 'gt' in data else None
+
+        buffer = []
+        num_buffered = 0
+        for val_data in dataloader:
+            if buffer and (num_buffered + val_data['lq'].size(0) > batch_size
+                           or _shape(val_data) != _shape(buffer[0])):
+                yield _collate(buffer)
+                buffer = []
+                num_buffered = 0
+            buffer.append(val_data)
+            num_buffered += val_data['lq'].size(0)
+        if buffer:
+            yield _collate(buffer)
+
+    @staticmethod
+    def _save_val_image(result, save_img_path):
+        """Convert and write one validation result. Run in a saver thread."""
+        imwrite(tensor2img([result]), save_img_path)
+
     def _log_validation_metric_values(self, current_iter, dataset_name, tb_logger):
         log_str = f'Validation {dataset_name}\n'
         for metric, value in self.metric_results.items():
@@ -209,4 +330,7 @@ class SRModel(BaseModel):
             self.save_network([self.net_g, self.net_g_ema], 'net_g', current_iter, param_key=['params', 'params_ema'])
         else:
             self.save_network(self.net_g, 'net_g', current_iter)
-        self.save_training_state(epoch, current_iter)
\ No newline at end of file
+        self.save_training_state(epoch, current_iter)
+        if current_iter == -1:
+            # the final 'latest' save ends training; flush it before exiting
+            self.wait_for_saving()
\ No newline at end of file
@@ -4,7 +4,7 @@ import torch.nn.functional as F
 
 from models.liif.models import register
 from models.liif import models
-from utils.utils_liif import make_coord
+from utils.utils_liif import cached_feat_coord
 
 
 @register('liif')
@@ -58,57 +58,172 @@ class LIIF(nn.Module):
         rx = 2 / feat.shape[-2] / 2
         ry = 2 / feat.shape[-1] / 2
 
-        feat_coord = make_coord(feat.shape[-2:], flatten=False).cuda() \
+        feat_coord = cached_feat_coord(*feat.shape[-2:], feat.device, feat.dtype) \
             .permute(2, 0, 1) \
             .unsqueeze(0).expand(feat.shape[0], 2, *feat.shape[-2:])
 
-        preds = []
-        areas = []
-        for vx in vx_lst:
-            for vy in vy_lst:
-                coord_ = coord.clone()
-                coord_[:, :, 0] += vx * rx + eps_shift
-                coord_[:, :, 1] += vy * ry + eps_shift
-                coord_.clamp_(-1 + 1e-6, 1 - 1e-6)
-                q_feat = F.grid_sample(
-                    feat, coord_.flip(-1).unsqueeze(1),
-                    mode='nearest', align_corners=False)[:, :, 0, :] \
-                    .permute(0, 2, 1)
-                q_coord = F.grid_sample(
-                    feat_coord, coord_.flip(-1).unsqueeze(1),
-                    mode='nearest', align_corners=False)[:, :, 0, :] \
-                    .permute(0, 2, 1)
-                rel_coord = coord - q_coord
-                rel_coord[:, :, 0] *= feat.shape[-2]
-                rel_coord[:, :, 1] *= feat.shape[-1]
-                inp = torch.cat([q_feat, rel_coord], dim=-1)
-
-                if self.cell_decode:
-                    rel_cell = cell.clone()
-                    rel_cell[:, :, 0] *= feat.shape[-2]
-                    rel_cell[:, :, 1] *= feat.shape[-1]
-                    inp = torch.cat([inp, rel_cell], dim=-1)
-
-                bs, q = coord.shape[:2]
-                pred = self.imnet(inp.view(bs * q, -1)).view(bs, q, -1)
-                preds.append(pred)
-
-                area = torch.abs(rel_coord[:, :, 0] * rel_coord[:, :, 1])
-                areas.append(area + 1e-9)
-
-        tot_area = torch.stack(areas).sum(dim=0)
+        # all shifted queries are stacked as (bs, n_shift * q, 2) so that
+        # grid_sample and imnet run once for the whole local ensemble
+        bs, q = coord.shape[:2]
+        shift = torch.tensor([[vx * rx + eps_shift, vy * ry + eps_shift]
+                              for vx in vx_lst for vy in vy_lst],
+                             dtype=coord.dtype, device=coord.device)
+        n_shift = shift.shape[0]
+        coord_ = (coord.unsqueeze(1) + shift.view(1, n_shift, 1, 2)) \
+            .clamp_(-1 + 1e-6, 1 - 1e-6).view(bs, n_shift * q, 2)
+        q_feat = F.grid_sample(
+            feat, coord_.flip(-1).unsqueeze(1),
+            mode='nearest', align_corners=False)[:, :, 0, :] \
+            .permute(0, 2, 1)
+        q_coord = F.grid_sample(
+            feat_coord, coord_.flip(-1).unsqueeze(1),
+            mode='nearest', align_corners=False)[:, :, 0, :] \
+            .permute(0, 2, 1)
+        rel_coord = coord.repeat(1, n_shift, 1) - q_coord
+        rel_coord[:, :, 0] *= feat.shape[-2]
+        rel_coord[:, :, 1] *= feat.shape[-1]
+        inp = torch.cat([q_feat, rel_coord], dim=-1)
+
+        if self.cell_decode:
+            rel_cell = cell.clone()
+            rel_cell[:, :, 0] *= feat.shape[-2]
+            rel_cell[:, :, 1] *= feat.shape[-1]
+            inp = torch.cat([inp, rel_cell.repeat(1, n_shift, 1)], dim=-1)
+
+        pred = self.imnet(inp.view(bs * n_shift * q, -1)).view(bs, n_shift, q, -1)
+
+        area = torch.abs(rel_coord[:, :, 0] * rel_coord[:, :, 1]).view(bs, n_shift, q) + 1e-9
+        tot_area = area.sum(dim=1, keepdim=True)
         if self.local_ensemble:
-            t = areas[0];
-            areas[0] = areas[3];
-            areas[3] = t
-            t = areas[1];
-            areas[1] = areas[2];
-            areas[2] = t
-        ret = 0
-        for pred, area in zip(preds, areas):
-            ret = ret + pred * (area / tot_area).unsqueeze(-1)
+            # each prediction is weighted by the area of the diagonally
+            # opposite shift (swaps 0 <-> 3 and 1 <-> 2)
+            area = area.flip(1)
+        ret = (pred * (area / tot_area).unsqueeze(-1)).sum(dim=1)
         return ret
 
+    @staticmethod
+    def _grid_index(seq, n, shift):
+        """ Feature index picked by the nearest grid_sample of query_rgb for
+            the coordinates seq shifted by shift, on an axis of n features.
+        """
+        shift = torch.tensor(shift, dtype=seq.dtype, device=seq.device)
+        x = (seq + shift).clamp_(-1 + 1e-6, 1 - 1e-6)
+        return torch.round(((x + 1) * n - 1) / 2).long().clamp_(0, n - 1)
+
+    def query_rgb_grid(self, scale, bsize=30000, out_device=None):
+        """ query_rgb on the whole regular HR grid of an integer scale,
+            i.e. coord = make_coord((h * scale, w * scale)) and
+            cell = 2 / (h * scale, w * scale) for (h, w) features.
+            The nearest lookups only depend on the row / column, so they
+            are computed once per axis and replaced by indexed gathers;
+            the result matches the general path. Rows are processed in
+            bands of about bsize coordinates.
+        """
+        feat = self.feat
+        bs, _, h, w = feat.shape
+        H, W = h * scale, w * scale
+
+        if self.imnet is None:
+            coord = cached_feat_coord(H, W, feat.device, feat.dtype).view(1, -1, 2).expand(bs, -1, -1)
+            return self.batched_query_rgb(coord, None, bsize, out_device)
+
+        if self.feat_unfold:
+            feat = F.unfold(feat, 3, padding=1).view(
+                feat.shape[0], feat.shape[1] * 9, feat.shape[2], feat.shape[3])
+
+        if self.local_ensemble:
+            v_lst = [-1, 1]
+            eps_shift = 1e-6
+        else:
+            v_lst, eps_shift = [0], 0
+        rx = 2 / h / 2
+        ry = 2 / w / 2
+
+        hr_coord = cached_feat_coord(H, W, feat.device, feat.dtype)
+        hr_rows, hr_cols = hr_coord[:, 0, 0], hr_coord[0, :, 1]
+        feat_coord = cached_feat_coord(h, w, feat.device, feat.dtype)
+        feat_rows, feat_cols = feat_coord[:, 0, 0], feat_coord[0, :, 1]
+
+        # per shift: feature indices and relative coords of every HR row / column
+        row_idx = [self._grid_index(hr_rows, h, vx * rx + eps_shift) for vx in v_lst]
+        col_idx = [self._grid_index(hr_cols, w, vy * ry + eps_shift) for vy in v_lst]
+        rel_rows = [(hr_rows - feat_rows[idx]) * h for idx in row_idx]
+        rel_cols = [(hr_cols - feat_cols[idx]) * w for idx in col_idx]
+        shifts = [(i, j) for i in range(len(v_lst)) for j in range(len(v_lst))]
+        n_shift = len(shifts)
+
+        rel_cell = None
+        if self.cell_decode:
+            rel_cell = torch.tensor([2 / H, 2 / W], dtype=feat.dtype, device=feat.device)
+            rel_cell[0] *= h
+            rel_cell[1] *= w
+
+        ret = None
+        band = max(1, bsize // W)
+        for r0 in range(0, H, band):
+            r1 = min(r0 + band, H)
+            hb = r1 - r0
+            inps = []
+            areas = []
+            for i, j in shifts:
+                q_feat = feat[:, :, row_idx[i][r0: r1]][:, :, :, col_idx[j]] \
+                    .permute(0, 2, 3, 1)
+                # 'ij' grid by broadcasting (torch.meshgrid only takes indexing= since 1.10)
+                rel_coord = torch.stack([
+                    rel_rows[i][r0: r1].view(hb, 1).expand(hb, W),
+                    rel_cols[j].view(1, W).expand(hb, W),
+                ], dim=-1)
+                inp = [q_feat, rel_coord.unsqueeze(0).expand(bs, -1, -1, -1)]
+                if rel_cell is not None:
+                    inp.append(rel_cell.view(1, 1, 1, 2).expand(bs, hb, W, -1))
+                inps.append(torch.cat(inp, dim=-1))
+                areas.append(torch.abs(rel_coord[:, :, 0] * rel_coord[:, :, 1]).view(-1) + 1e-9)
+
+            inp = torch.stack(inps, dim=1)
+            pred = self.imnet(inp.view(bs * n_shift * hb * W, -1)).view(bs, n_shift, hb * W, -1)
+
+            area = torch.stack(areas).unsqueeze(0)
+            tot_area = area.sum(dim=1, keepdim=True)
+            if self.local_ensemble:
+                area = area.flip(1)
+            if ret is None:
+                ret = torch.empty(bs, H * W, pred.shape[-1], dtype=pred.dtype,
+                                  device=feat.device if out_device is None else out_device)
+            ret[:, r0 * W: r1 * W, :] = (pred * (area / tot_area).unsqueeze(-1)).sum(dim=1)
+        return ret
+
+    @torch.no_grad()
+    def predict_grid(self, inp, scale, bsize=30000, out_device=None):
+        """ Encodes inp once and queries the regular HR grid of an integer scale. """
+        self.gen_feat(inp)
+        return self.query_rgb_grid(scale, bsize, out_device)
+
+    def batched_query_rgb(self, coord, cell=None, bsize=30000, out_device=None):
+        """ Queries the features of the last gen_feat call in chunks of bsize
+            coordinates, writing into a preallocated output.
+            out_device: device of the output (e.g. 'cpu' for very large
+            outputs), defaults to the device of coord.
+        """
+        bs, n = coord.shape[:2]
+        ret = None
+        ql = 0
+        while ql < n:
+            qr = min(ql + bsize, n)
+            pred = self.query_rgb(coord[:, ql: qr, :],
+                                  None if cell is None else cell[:, ql: qr, :])
+            if ret is None:
+                ret = torch.empty(bs, n, pred.shape[-1], dtype=pred.dtype,
+                                  device=coord.device if out_device is None else out_device)
+            ret[:, ql: qr, :] = pred
+            ql = qr
+        return ret
+
+    @torch.no_grad()
+    def batched_predict(self, inp, coord, cell, bsize=30000, out_device=None):
+        """ Encodes inp once and queries coord in chunks of bsize. """
+        self.gen_feat(inp)
+        return self.batched_query_rgb(coord, cell, bsize, out_device)
+
     def forward(self, inp, coord, cell):
         self.gen_feat(inp)
         return self.query_rgb(coord, cell)
@@ -4,7 +4,7 @@ import torch.nn.functional as F
 
 import models
 from models.liif.models import register
-from utils.utils_liif import make_coord
+from utils.utils_liif import cached_feat_coord
 
 
 @register('metasr')
@@ -33,7 +33,7 @@ class MetaSR(nn.Module):
         feat = F.unfold(feat, 3, padding=1).view(
             feat.shape[0], feat.shape[1] * 9, feat.shape[2], feat.shape[3])
 
-        feat_coord = make_coord(feat.shape[-2:], flatten=False).cuda()
+        feat_coord = cached_feat_coord(*feat.shape[-2:], feat.device, feat.dtype).clone()
         feat_coord[:, :, 0] -= (2 / feat.shape[-2]) / 2
         feat_coord[:, :, 1] -= (2 / feat.shape[-1]) / 2
         feat_coord = feat_coord.permute(2, 0, 1) \
@@ -0,0 +1,119 @@
+import torch
+import torch.nn.functional as F
+
+from models.liif import models
+from utils.utils_liif import make_coord
+
+
+def make_liif(local_ensemble=True, feat_unfold=True, cell_decode=True):
+    """Small LIIF with random weights."""
+    torch.manual_seed(0)
+    return models.make({
+        'name': 'liif',
+        'args': {
+            'encoder_spec': {'name': 'edsr-baseline', 'args': {'n_resblocks': 2, 'n_feats': 8, 'no_upsampling': True}},
+            'imnet_spec': {'name': 'mlp', 'args': {'out_dim': 3, 'hidden_list': [16, 16]}},
+            'local_ensemble': local_ensemble,
+            'feat_unfold': feat_unfold,
+            'cell_decode': cell_decode,
+        }
+    }).eval()
+
+
+def query_rgb_loop(model, coord, cell):
+    """Reference query_rgb: one grid_sample and imnet call per shift of the
+    local ensemble, as in the original LIIF implementation."""
+    feat = model.feat
+    if model.feat_unfold:
+        feat = F.unfold(feat, 3, padding=1).view(
+            feat.shape[0], feat.shape[1] * 9, feat.shape[2], feat.shape[3])
+
+    if model.local_ensemble:
+        vx_lst, vy_lst, eps_shift = [-1, 1], [-1, 1], 1e-6
+    else:
+        vx_lst, vy_lst, eps_shift = [0], [0], 0
+    rx = 2 / feat.shape[-2] / 2
+    ry = 2 / feat.shape[-1] / 2
+
+    feat_coord = make_coord(feat.shape[-2:], flatten=False) \
+        .permute(2, 0, 1) \
+        .unsqueeze(0).expand(feat.shape[0], 2, *feat.shape[-2:])
+
+    preds = []
+    areas = []
+    for vx in vx_lst:
+        for vy in vy_lst:
+            coord_ = coord.clone()
+            coord_[:, :, 0] += vx * rx + eps_shift
+            coord_[:, :, 1] += vy * ry + eps_shift
+            coord_.clamp_(-1 + 1e-6, 1 - 1e-6)
+            q_feat = F.grid_sample(
+                feat, coord_.flip(-1).unsqueeze(1),
+                mode='nearest', align_corners=False)[:, :, 0, :] \
+                .permute(0, 2, 1)
+            q_coord = F.grid_sample(
+                feat_coord, coord_.flip(-1).unsqueeze(1),
+                mode='nearest', align_corners=False)[:, :, 0, :] \
+                .permute(0, 2, 1)
+            rel_coord = coord - q_coord
+            rel_coord[:, :, 0] *= feat.shape[-2]
+            rel_coord[:, :, 1] *= feat.shape[-1]
+            inp = torch.cat([q_feat, rel_coord], dim=-1)
+
+            if model.cell_decode:
+                rel_cell = cell.clone()
+                rel_cell[:, :, 0] *= feat.shape[-2]
+                rel_cell[:, :, 1] *= feat.shape[-1]
+                inp = torch.cat([inp, rel_cell], dim=-1)
+
+            bs, q = coord.shape[:2]
+            preds.append(model.imnet(inp.view(bs * q, -1)).view(bs, q, -1))
+            areas.append(torch.abs(rel_coord[:, :, 0] * rel_coord[:, :, 1]) + 1e-9)
+
+    tot_area = torch.stack(areas).sum(dim=0)
+    if model.local_ensemble:
+        areas = areas[::-1]
+    ret = 0
+    for pred, area in zip(preds, areas):
+        ret = ret + pred * (area / tot_area).unsqueeze(-1)
+    return ret
+
+
+def grid_cell(h, w, bs=1):
+    coord = make_coord((h, w)).unsqueeze(0).expand(bs, -1, -1)
+    cell = torch.ones_like(coord)
+    cell[:, :, 0] *= 2 / h
+    cell[:, :, 1] *= 2 / w
+    return coord, cell
+
+
+def test_query_rgb_fused():
+    """The fused local ensemble of query_rgb matches the per-shift loop."""
+    inp = torch.rand(2, 3, 12, 10)
+    for local_ensemble in [True, False]:
+        for feat_unfold in [True, False]:
+            model = make_liif(local_ensemble, feat_unfold)
+            with torch.no_grad():
+                model.gen_feat(inp)
+                # a regular grid and random (e.g. non-integer scale) queries
+                coord, cell = grid_cell(30, 25, bs=2)
+                coord = torch.cat([coord, torch.rand(2, 100, 2) * 2 - 1], dim=1)
+                cell = torch.cat([cell, cell[:, :100]], dim=1)
+                ret = model.query_rgb(coord, cell)
+                ref = query_rgb_loop(model, coord, cell)
+            assert torch.allclose(ret, ref, atol=1e-5), (local_ensemble, feat_unfold, (ret - ref).abs().max())
+
+
+def test_query_rgb_grid():
+    """query_rgb_grid matches query_rgb on the regular grid of an integer scale."""
+    inp = torch.rand(2, 3, 12, 10)
+    scale = 3
+    for local_ensemble in [True, False]:
+        model = make_liif(local_ensemble)
+        with torch.no_grad():
+            model.gen_feat(inp)
+            coord, cell = grid_cell(12 * scale, 10 * scale, bs=2)
+            ref = model.query_rgb(coord, cell)
+            # a small bsize splits the grid into several row bands
+            ret = model.query_rgb_grid(scale, bsize=100)
+        assert torch.allclose(ret, ref, atol=1e-5), (local_ensemble, (ret - ref).abs().max())
@@ -8,6 +8,7 @@ import torch.nn.functional as F
 
 import math
 import os
+import time
 import cv2
 import sys
 import rasterio
@@ -133,8 +134,52 @@ class noiseLayer_normal(nn.Module):
 
         return x
 
+def _window_starts(n, wind, stride):
+    """Window starts covering n pixels, the last one flush with the edge"""
+    if n <= wind:
+        return [0]
+    return list(range(0, n - wind, stride)) + [n - wind]
+
+def window_layout(H, W, wind_size=512, stride=480, tile=None, overlap=0):
+    """
+    Sliding windows over an (H, W) image, see WindowsDataset_SR
+    
+    return:
+        list of (y0,y1,x0,x1) windows, crop height, crop width, window size
+    """
+    if tile is None:
+        coordinates = [
+            (j, min(j+wind_size, H), i, min(i+wind_size, W))
+            for j in range(0, H, stride) for i in range(0, W, stride)
+        ]
+        return coordinates, wind_size, wind_size, wind_size
+    
+    wind_size = max(16, math.ceil(W * tile))
+    stride = max(1, wind_size - overlap)
+    crop_h, crop_w = min(wind_size, H), min(wind_size, W)
+    coordinates = [
+        (y0, y0+crop_h, x0, x0+crop_w)
+        for y0 in _window_starts(H, crop_h, stride) for x0 in _window_starts(W, crop_w, stride)
+    ]
+    return coordinates, crop_h, crop_w, wind_size
+
+def inference_cost(H, W, wind_size=512, stride=480, scale=2, padding=5, tile=None):
+    """
+    Input pixels the network runs on to super-resolve an (H, W) image with
+    process_file_msrn (windows of the downscaled image plus their padding),
+    used to compare the cost of inference settings
+    """
+    h, w = (H + 2*padding) // scale, (W + 2*padding) // scale
+    coordinates, crop_h, crop_w, _ = window_layout(h, w, wind_size, stride, tile=tile, overlap=2*padding)
+    return len(coordinates) * (crop_h + 2*padding) * (crop_w + 2*padding)
+
 class WindowsDataset_SR(data.Dataset):
-    def __init__(self, nimg, wind_size=512, stride=480, scale=2):
+    def __init__(self, nimg, wind_size=512, stride=480, scale=2, tile=None, overlap=0):
+        """
+        tile: if set, windows are a tile fraction of the (downscaled) width
+            instead of wind_size, overlap by overlap pixels and are shifted
+            inside the image at the edges, so no crop is zero-filled
+        """
         
         x_in = kornia.image_to_tensor(nimg).float()
         x_in = torch.unsqueeze(x_in, 0)
@@ -156,19 +201,10 @@ class WindowsDataset_SR(data.Dataset):
         self.H_out = H*scale
         self.W_out = W*scale
 
+        self.coordinates_input, self.crop_h, self.crop_w, self.wind_size = window_layout(
+            H, W, wind_size, stride, tile=tile, overlap=overlap
+        )
         self.stride = stride
-        self.wind_size = wind_size
-                
-        # get all locations
-        self.coordinates_input = []
-        for j in range(0, self.H, self.stride):
-            for i in range(0, self.W, self.stride):
-                y0=j
-                y1=min(j+self.wind_size, self.H)
-                x0=i
-                x1=min(i+self.wind_size, self.W)
-                
-                self.coordinates_input.append((y0,y1,x0,x1))
             
     def __len__(self):
         return len(self.coordinates_input)
@@ -177,7 +213,7 @@ class WindowsDataset_SR(data.Dataset):
         y0,y1,x0,x1=self.coordinates_input[index]
         w = x1-x0
         h = y1-y0
-        crop = np.zeros((self.wind_size,self.wind_size,3))
+        crop = np.zeros((self.crop_h,self.crop_w,3))
 
         crop[:h, :w] = self.nimg[y0:y1, x0:x1]
 
@@ -194,8 +230,13 @@ class WindowsDataset_SR(data.Dataset):
         return sample
 
 
+class InferenceTimeout(Exception):
+    """Raised by inference_model when its deadline has passed"""
+    pass
+
 def inference_model(model, nimg, wind_size=512, stride=480, scale=2, 
-                    batch_size=1, data_parallel=False, padding=5, manager=None, add_noise=None):
+                    batch_size=1, data_parallel=False, padding=5, manager=None, add_noise=None,
+                    deadline=None, tile=None):
     """
     Run sliding window on data using the sisr model.
     
@@ -204,11 +245,16 @@ def inference_model(model, nimg, wind_size=512, stride=480, scale=2,
         data (H,W,C) in BGR format normalized between 0-1 (float)
         wind_size
         stride
+        deadline: time.time() after which no new window is started, raising InferenceTimeout
+            (checked between windows only, so a single window runs to the end)
+        tile: windows of a tile fraction of the width, overlapping by 2*padding,
+            instead of wind_size / stride (see WindowsDataset_SR)
     returns:
         super resolved image xscale. Numpy array (H,W,C) BGR 0-1 (float)
     """
     
-    # get device
+    # get device (quantized models have no float parameters and run on the cpu)
+    device = -1
     for p in model.parameters():
         device = p.get_device()
         break
@@ -221,7 +267,7 @@ def inference_model(model, nimg, wind_size=512, stride=480, scale=2,
     H,W,C=nimg.shape
     
     # init dataset 
-    dataset = WindowsDataset_SR(nimg, wind_size, stride, scale)
+    dataset = WindowsDataset_SR(nimg, wind_size, stride, scale, tile=tile, overlap=2*padding)
     
     # dataloader
     dataloader = torch.utils.data.DataLoader(dataset, batch_size)
@@ -236,6 +282,9 @@ def inference_model(model, nimg, wind_size=512, stride=480, scale=2,
 
     for sample in dataloader:
 
+        if deadline is not None and time.time() > deadline:
+            raise InferenceTimeout(f'deadline passed, window size {dataset.wind_size}')
+
         if not data_parallel:
             x_in = sample['x_in'].to(device)
         else:
@@ -267,7 +316,7 @@ def inference_model(model, nimg, wind_size=512, stride=480, scale=2,
 
             hh,ww,cc = output[Y0:Y1, X0:X1].shape
 
-            if (hh<scale*wind_size) or (ww<scale*wind_size):
+            if (hh<scale*dataset.crop_h) or (ww<scale*dataset.crop_w):
                 Y1=Y0+hh
                 X1=X0+ww
                 pred_sample = pred_sample[:hh, :ww]
@@ -285,23 +334,22 @@ def load_msrn_model(weights_path=None, cuda='0',n_scale=3):
     
     args:
         path to weights (default model_epoch_101.pth located in Nas) x2 scale
-        cuda '0' or set to None if yoy want CPU usage
+        cuda '0' or set to None if yoy want CPU usage (also used when no GPU is available)
     
     return:
         pytorch MSRN
     """
-    if cuda is not None:
+    if cuda is not None and torch.cuda.is_available():
         import os
         os.environ["CUDA_VISIBLE_DEVICES"]=cuda
+    else:
+        cuda = None
     model = MSRN_Upscale(n_scale=n_scale)
     
     if weights_path is None:
         weights_path="model.pth"
         
-    if not torch.cuda.is_available():
-        weights = torch.load(weights_path,  map_location=torch.device('cpu'))
-    else:
-        weights = torch.load(weights_path)
+    weights = torch.load(weights_path,  map_location=torch.device('cpu'))
 
     #model.load_state_dict(weights)
     model.load_state_dict(weights['model'].state_dict())
@@ -316,7 +364,7 @@ def load_msrn_model(weights_path=None, cuda='0',n_scale=3):
 def process_file_msrn(
     nimg, model, compress=True, out_win=256,
     wind_size=512, stride=480, batch_size=1,
-    scale=2, padding=5, manager=None
+    scale=2, padding=5, manager=None, deadline=None, tile=None
 ):
     
     # nimg = inria image at 0.3
@@ -340,7 +388,7 @@ def process_file_msrn(
         model, nimg,
         wind_size=wind_size, stride=stride,
         scale=scale, batch_size=batch_size,
-        manager=manager, add_noise=None
+        manager=manager, add_noise=None, deadline=deadline, tile=tile
     ) # you can add noise during inference to get smoother results (try from 0.1 to 0.3; the higher the smoother effect!) 
 
     result = result[2*padding:-2*padding,2*padding:-2*padding]
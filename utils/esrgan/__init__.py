@@ -1,9 +1,12 @@
+from .checkpoint_saver import CheckpointSaver
 from .file_client import FileClient
 from .img_util import crop_border, imfrombytes, img2tensor, imwrite, tensor2img
 from .logger import MessageLogger, get_env_info, get_root_logger, init_tb_logger, init_wandb_logger
 from .misc import check_resume, get_time_str, make_exp_dirs, mkdir_and_rename, scandir, set_random_seed, sizeof_fmt
 
 __all__ = [
+    # checkpoint_saver.py
+    'CheckpointSaver',
     # file_client.py
     'FileClient',
     # img_util.py
@@ -0,0 +1,140 @@
+import atexit
+import os
+import queue
+import re
+import threading
+import torch
+from collections import OrderedDict
+
+from .logger import get_root_logger
+
+
+def state_to_cpu(state):
+    """Snapshot a (nested) state to CPU memory.
+    Tensors are always copied, also when they already live on the CPU, so
+    that training can keep updating them while the snapshot is written.
+    Args:
+        state (Tensor | dict | list | tuple | obj): The state to snapshot.
+    Returns:
+        A structure of the same type with tensors copied to the CPU.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, OrderedDict):
+        return OrderedDict((k, state_to_cpu(v)) for k, v in state.items())
+    elif isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
+class CheckpointSaver():
+    """Checkpoint saver with a background writer thread.
+    Files are first written to ``<path>.tmp`` and renamed afterwards, so a
+    crash during saving never leaves a truncated checkpoint behind. When
+    ``max_keep`` is set, only the newest ``max_keep`` checkpoints of each
+    group (e.g. ``net_g_*.pth`` or ``*.state``) are kept on disk; the
+    ``latest`` checkpoints are never removed.
+    Args:
+        async_mode (bool): If True, write checkpoints on a background thread.
+            Otherwise, write them in the caller. Default: True.
+        max_keep (int | None): Number of checkpoints kept per group. None
+            keeps all of them. Default: None.
+        max_pending (int): Maximum number of checkpoints waiting to be
+            written. ``save`` blocks when the queue is full. Default: 2.
+    """
+
+    def __init__(self, async_mode=True, max_keep=None, max_pending=2):
+        self.async_mode = async_mode
+        self.max_keep = max_keep
+        self._saved = {}
+        self._error = None
+        if self.async_mode:
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._thread = threading.Thread(target=self._worker, name='checkpoint-saver', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def save(self, state, save_path):
+        """Save a state to ``save_path``.
+        The state is snapshotted to the CPU before returning, so it is safe
+        to modify it right after this call.
+        Args:
+            state (obj): Object to be saved with ``torch.save``.
+            save_path (str): Destination path.
+        """
+        self._raise_error()
+        state = state_to_cpu(state)
+        if self.async_mode:
+            self._queue.put((state, save_path))
+        else:
+            self._write(state, save_path)
+
+    def wait(self):
+        """Block until every pending checkpoint is written."""
+        if self.async_mode:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Flush pending checkpoints and stop the writer thread."""
+        if self.async_mode and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+                get_root_logger().error(f'Failed to save checkpoint: {e}')
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, save_path):
+        tmp_path = f'{save_path}.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, save_path)
+        self._remove_old(save_path)
+
+    def _remove_old(self, save_path):
+        if self.max_keep is None:
+            return
+        dirname, filename = os.path.split(save_path)
+        match = re.match(r'^(.*?)(\d+)(\.\w+)$', filename)
+        if match is None:  # e.g. net_g_latest.pth
+            return
+        group = (dirname, match.group(1), match.group(3))
+        if group not in self._saved:
+            # checkpoints of an earlier (resumed) run are pruned too
+            self._saved[group] = self._list_group(*group)
+        saved = self._saved[group]
+        if save_path in saved:
+            saved.remove(save_path)
+        saved.append(save_path)
+        while len(saved) > self.max_keep:
+            old_path = saved.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    @staticmethod
+    def _list_group(dirname, prefix, ext):
+        """Existing checkpoints of a group, oldest (lowest number) first."""
+        pattern = re.compile(r'^' + re.escape(prefix) + r'(\d+)' + re.escape(ext) + r'$')
+        found = []
+        for filename in os.listdir(dirname or '.'):
+            match = pattern.match(filename)
+            if match is not None:
+                found.append((int(match.group(1)), os.path.join(dirname, filename)))
+        return [path for _, path in sorted(found)]
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Checkpoint saving failed.') from error
@@ -1,4 +1,5 @@
 import cv2
+import functools
 import numpy as np
 import os
 import sys
@@ -52,6 +53,28 @@ def worker(path, opt):
     Returns:
         process_info (str): Process information displayed in progress bar.
     """
+    img_name, extension = osp.splitext(osp.basename(path))
+    for key, cropped_img in crop_subimages(path, opt):
+        cv2.imwrite(
+            osp.join(opt['save_folder'], f'{key}{extension}'), cropped_img,
+            [cv2.IMWRITE_PNG_COMPRESSION, opt['compression_level']])
+    process_info = f'Processing {img_name} ...'
+    return process_info
+
+
+def crop_subimages(path, opt):
+    """Crop one image into overlapped sub-images.
+    Args:
+        path (str): Image path.
+        opt (dict): Configuration dict. It contains:
+            crop_size (int): Crop size.
+            step (int): Step for overlapped sliding window.
+            thresh_size (int): Threshold size. Patches whose size is lower
+                than thresh_size will be dropped.
+    Yields:
+        tuple(str, ndarray): Sub-image key (file name without extension)
+            and the contiguous cropped image.
+    """
     crop_size = opt['crop_size']
     step = opt['step']
     thresh_size = opt['thresh_size']
@@ -82,11 +105,150 @@ def worker(path, opt):
             index += 1
             cropped_img = img[x:x + crop_size, y:y + crop_size, ...]
             cropped_img = np.ascontiguousarray(cropped_img)
-            cv2.imwrite(
-                osp.join(opt['save_folder'], f'{img_name}_s{index:03d}{extension}'), cropped_img,
-                [cv2.IMWRITE_PNG_COMPRESSION, opt['compression_level']])
-    process_info = f'Processing {img_name} ...'
-    return process_info
+            yield f'{img_name}_s{index:03d}', cropped_img
+
+
+def extract_subimages_lmdb(opt):
+    """Crop images to sub-images and write them straight into sharded lmdb.
+    Sub-images never touch the disk as single files. Each shard is an lmdb
+    database ``shard_XXX.lmdb`` under ``save_folder`` with its own
+    ``meta_info.txt``, and it is written by its own process. ``save_folder``
+    then gets the combined ``meta_info.txt`` read by lmdb datasets and a
+    ``shard_index.txt`` mapping each key to its shard, so
+    ``FileClient('lmdb', db_paths=save_folder)`` reads any key of any shard
+    (name ``save_folder`` ``*.lmdb`` for the lmdb datasets).
+    Args:
+        opt (dict): Configuration dict. It contains:
+            input_folder (str): Path to the input folder.
+            save_folder (str): Path to save folder.
+            n_shard (int): Number of lmdb shards (and writer processes).
+            crop_size (int): Crop size.
+            step (int): Step for overlapped sliding window.
+            thresh_size (int): Threshold size. Patches whose size is lower
+                than thresh_size will be dropped.
+            compression_level (int): for cv2.IMWRITE_PNG_COMPRESSION.
+            map_size (int, optional): Maximum size in bytes of each shard.
+                Default: 1TB, which is only reserved address space.
+            commit_interval (int, optional): Number of source images written
+                per lmdb transaction. Default: 100.
+    Returns:
+        list[str]: Paths of the lmdb shards.
+    """
+    input_folder = opt['input_folder']
+    save_folder = opt['save_folder']
+    if not osp.exists(save_folder):
+        os.makedirs(save_folder)
+        print(f'mkdir {save_folder} ...')
+    else:
+        print(f'Folder {save_folder} already exists. Exit.')
+        sys.exit(1)
+
+    img_list = sorted(scandir(input_folder, full_path=True))
+    n_shard = min(opt['n_shard'], len(img_list))
+    shard_paths = [osp.join(save_folder, f'shard_{i:03d}.lmdb') for i in range(n_shard)]
+
+    pbar = tqdm(total=n_shard, unit='shard', desc='Write lmdb')
+    pool = Pool(n_shard)
+    results = [
+        pool.apply_async(
+            lmdb_shard_worker, args=(img_list[i::n_shard], shard_path, opt), callback=lambda arg: pbar.update(1))
+        for i, shard_path in enumerate(shard_paths)
+    ]
+    pool.close()
+    pool.join()
+    pbar.close()
+    for result in results:
+        result.get()  # re-raise errors of the writers
+
+    # combined meta info and key -> shard index of the whole folder
+    with open(osp.join(save_folder, 'meta_info.txt'), 'w') as f_meta, \
+            open(osp.join(save_folder, 'shard_index.txt'), 'w') as f_index:
+        for shard_path in shard_paths:
+            with open(osp.join(shard_path, 'meta_info.txt'), 'r') as f:
+                for line in f:
+                    f_meta.write(line)
+                    f_index.write(f'{line.split(".png")[0]} {osp.basename(shard_path)}\n')
+    print('All processes done.')
+    return shard_paths
+
+
+def lmdb_shard_worker(img_paths, lmdb_path, opt):
+    """Writer for one lmdb shard.
+    Args:
+        img_paths (list[str]): Source image paths of this shard.
+        lmdb_path (str): Path of the lmdb shard.
+        opt (dict): Configuration dict, see :func:`extract_subimages_lmdb`.
+    Returns:
+        process_info (str): Process information displayed in progress bar.
+    """
+    import lmdb
+
+    compression_level = opt['compression_level']
+    commit_interval = opt.get('commit_interval', 100)
+    env = lmdb.open(lmdb_path, map_size=opt.get('map_size', 1 << 40))
+    txn = env.begin(write=True)
+    meta_info = []
+    for idx, path in enumerate(img_paths):
+        for key, cropped_img in crop_subimages(path, opt):
+            _, img_byte = cv2.imencode('.png', cropped_img, [cv2.IMWRITE_PNG_COMPRESSION, compression_level])
+            txn.put(key.encode('ascii'), img_byte.tobytes())
+            h, w = cropped_img.shape[:2]
+            c = 1 if cropped_img.ndim == 2 else cropped_img.shape[2]
+            meta_info.append(f'{key}.png ({h},{w},{c}) {compression_level}\n')
+        if (idx + 1) % commit_interval == 0:
+            txn.commit()
+            txn = env.begin(write=True)
+    txn.commit()
+    env.close()
+
+    with open(osp.join(lmdb_path, 'meta_info.txt'), 'w') as f:
+        f.writelines(meta_info)
+    return f'Writing {lmdb_path} ...'
+
+
+def extract_subimages_mmap(opt):
+    """Crop images to sub-images and pack them into one memory-mapped file.
+    The decoded sub-images are appended to ``save_folder/data.bin`` and
+    indexed in ``save_folder/index.txt``, the layout read by the ``mmap``
+    FileClient backend. Cropping runs in ``n_thread`` processes while the
+    main process writes the file sequentially.
+    Args:
+        opt (dict): Configuration dict. It contains:
+            input_folder (str): Path to the input folder.
+            save_folder (str): Path to save folder.
+            n_thread (int): Thread number.
+            crop_size (int): Crop size.
+            step (int): Step for overlapped sliding window.
+            thresh_size (int): Threshold size. Patches whose size is lower
+                than thresh_size will be dropped.
+    """
+    input_folder = opt['input_folder']
+    save_folder = opt['save_folder']
+    if not osp.exists(save_folder):
+        os.makedirs(save_folder)
+        print(f'mkdir {save_folder} ...')
+    else:
+        print(f'Folder {save_folder} already exists. Exit.')
+        sys.exit(1)
+
+    img_list = sorted(scandir(input_folder, full_path=True))
+
+    pbar = tqdm(total=len(img_list), unit='image', desc='Pack')
+    offset = 0
+    with Pool(opt['n_thread']) as pool, open(osp.join(save_folder, 'data.bin'), 'wb') as f_data, \
+            open(osp.join(save_folder, 'index.txt'), 'w') as f_index:
+        for crops in pool.imap(functools.partial(_crop_subimages_list, opt=opt), img_list):
+            for key, cropped_img in crops:
+                f_data.write(cropped_img.tobytes())
+                f_index.write(f'{key} {offset} {",".join(str(v) for v in cropped_img.shape)}\n')
+                offset += cropped_img.nbytes
+            pbar.update(1)
+    pbar.close()
+    print('All processes done.')
+
+
+def _crop_subimages_list(path, opt):
+    return list(crop_subimages(path, opt))
 
 
 def subimage_extractor():
@@ -107,6 +269,10 @@ def subimage_extractor():
             After process, each sub_folder should have the same number of
             subimages.
             Remember to modify opt configurations according to your settings.
+            Use ``extract_subimages_lmdb`` instead of ``extract_subimages``
+            (with ``n_shard``) to write lmdb shards instead of png files, or
+            ``extract_subimages_mmap`` to pack decoded sub-images into one
+            memory-mapped file.
         """
 
     opt = {}
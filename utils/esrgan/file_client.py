@@ -1,4 +1,10 @@
+import hashlib
+import numpy as np
+import os
+import queue
+import threading
 from abc import ABCMeta, abstractmethod
+from os import path as osp
 
 
 class BaseStorageBackend(metaclass=ABCMeta):
@@ -17,9 +23,9 @@ class BaseStorageBackend(metaclass=ABCMeta):
         pass
 
 
-class MemcachedBackend(BaseStorageBackend):
-    """Memcached storage backend.
-    Attributes:
+class McTransport():
+    """Transport to a memcached service through the ``mc`` client.
+    Args:
         server_list_cfg (str): Config file for memcached server list.
         client_cfg (str): Config file for memcached client.
         sys_path (str | None): Additional path to be appended to `sys.path`.
@@ -35,19 +41,200 @@ class MemcachedBackend(BaseStorageBackend):
         except ImportError:
             raise ImportError('Please install memcached to enable MemcachedBackend.')
 
-        self.server_list_cfg = server_list_cfg
-        self.client_cfg = client_cfg
-        self._client = mc.MemcachedClient.GetInstance(self.server_list_cfg, self.client_cfg)
+        self._mc = mc
+        self._client = mc.MemcachedClient.GetInstance(server_list_cfg, client_cfg)
         # mc.pyvector servers as a point which points to a memory cache
         self._mc_buffer = mc.pyvector()
 
+    def get(self, key):
+        """The value of key, an empty buffer on a miss (as the ``mc`` client)."""
+        self._client.Get(key, self._mc_buffer)
+        return self._mc.ConvertBuffer(self._mc_buffer)
+
+    def set(self, key, value):
+        self._client.Set(key, value)
+
+
+class LocalCacheTransport():
+    """Single-node stand-in for memcached, with no outside service.
+    Values are files in a shared-memory folder (``/dev/shm`` by default), so
+    every process of the node, e.g. all the DataLoader workers, shares the
+    same cache. Bytes are stored as they are; ``np.ndarray`` values (e.g.
+    decoded patches) are stored as ``.npy`` files and returned as read-only
+    memory maps. When the cache grows over ``max_size``, the least recently
+    used entries are removed.
+    Args:
+        cache_dir (str): Cache folder. Default: '/dev/shm/esrgan_cache'.
+        max_size (float): Cache budget in MB. Default: 4096.
+    """
+
+    def __init__(self, cache_dir='/dev/shm/esrgan_cache', max_size=4096):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 1024**2)
+        self._written = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return osp.join(self.cache_dir, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if osp.exists(path + '.npy'):
+                value = np.load(path + '.npy', mmap_mode='r')
+                path = path + '.npy'
+            else:
+                with open(path, 'rb') as f:
+                    value = f.read()
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError):  # missing or being evicted
+            return None
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        if isinstance(value, np.ndarray):
+            path = path + '.npy'
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            if isinstance(value, np.ndarray):
+                np.save(f, value)
+            else:
+                f.write(value)
+        os.replace(tmp_path, path)
+
+        # the size of the whole cache is only checked after each process
+        # wrote another tenth of the budget
+        self._written += osp.getsize(path)
+        if self._written > self.max_size // 10:
+            self._written = 0
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(v[1] for v in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class MemcachedBackend(BaseStorageBackend):
+    """Memcached storage backend.
+    Reads go through a pool of transport clients, so the backend is safe to
+    use from several threads. The pool is created lazily in each process, so
+    the backend can be pickled for spawned DataLoader workers. With the
+    'local' transport, it works as a read-through cache: missing values are
+    read from disk and stored. With 'mc', a miss returns an empty buffer.
+    Attributes:
+        server_list_cfg (str): Config file for memcached server list.
+        client_cfg (str): Config file for memcached client.
+        sys_path (str | None): Additional path to be appended to `sys.path`.
+            Default: None.
+        transport (str): 'mc' for a memcached service through the ``mc``
+            client, or 'local' for :class:`LocalCacheTransport`.
+            Default: 'mc'.
+        pool_size (int): Number of transport clients. Default: 1.
+        transport_kwargs (dict): Arguments of :class:`LocalCacheTransport`.
+        hits (int): Number of values found in the cache.
+        misses (int): Number of values not found in the cache.
+    """
+
+    _transports = {
+        'mc': McTransport,
+        'local': LocalCacheTransport,
+    }
+
+    def __init__(self, server_list_cfg=None, client_cfg=None, sys_path=None, transport='mc', pool_size=1,
+                 **transport_kwargs):
+        if transport not in self._transports:
+            raise ValueError(f'Transport {transport} is not supported. Currently supported ones'
+                             f' are {list(self._transports.keys())}')
+        if transport == 'mc':
+            transport_kwargs.update(server_list_cfg=server_list_cfg, client_cfg=client_cfg, sys_path=sys_path)
+
+        self.server_list_cfg = server_list_cfg
+        self.client_cfg = client_cfg
+        self.transport = transport
+        self.pool_size = pool_size
+        self.transport_kwargs = transport_kwargs
+        self._pid = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # transport clients, the queue and the lock can not be pickled, recreate them lazily
+        state = self.__dict__.copy()
+        state.update(_pid=None, _pool=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        """Pool of transport clients, created once in each process."""
+        with self._lock:
+            if self._pid != os.getpid():
+                pool = queue.Queue()
+                for _ in range(self.pool_size):
+                    pool.put(self._transports[self.transport](**self.transport_kwargs))
+                self._pool, self._pid = pool, os.getpid()
+                self.hits = self.misses = 0
+        return self._pool
+
     def get(self, filepath):
         filepath = str(filepath)
-        import mc
-        self._client.Get(filepath, self._mc_buffer)
-        value_buf = mc.ConvertBuffer(self._mc_buffer)
+        pool = self._get_pool()
+        client = pool.get()
+        try:
+            value_buf = client.get(filepath)
+            if value_buf is None and self.transport == 'local':
+                with open(filepath, 'rb') as f:
+                    value_buf = f.read()
+                client.set(filepath, value_buf)
+                hit = False
+            else:
+                hit = value_buf is not None and len(value_buf) > 0
+        finally:
+            pool.put(client)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
         return value_buf
 
+    def set(self, filepath, value):
+        """Store a value, e.g. a decoded patch, to be shared with the other
+        readers of the cache.
+        """
+        pool = self._get_pool()
+        client = pool.get()
+        try:
+            client.set(str(filepath), value)
+        finally:
+            pool.put(client)
+
+    def stats(self):
+        """Return the hit and miss counters of this backend."""
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total > 0 else 0.)
+
     def get_text(self, filepath):
         raise NotImplementedError
 
@@ -70,8 +257,13 @@ class HardDiskBackend(BaseStorageBackend):
 
 class LmdbBackend(BaseStorageBackend):
     """Lmdb storage backend.
+    Lmdb environments are opened lazily in each process, so the backend can
+    be created before DataLoader workers are forked (or pickled for spawn).
+    A db path may also be a folder of shards written by
+    ``extract_subimages_lmdb``: its ``shard_index.txt`` tells which shard
+    holds each key, so the shards are read as one database.
     Args:
-        db_paths (str | list[str]): Lmdb database paths.
+        db_paths (str | list[str]): Lmdb database (or shard folder) paths.
         client_keys (str | list[str]): Lmdb client keys. Default: 'default'.
         readonly (bool, optional): Lmdb environment parameter. If True,
             disallow any write operations. Default: True.
@@ -81,14 +273,25 @@ class LmdbBackend(BaseStorageBackend):
             disable the OS filesystem readahead mechanism, which may improve
             random read performance when a database is larger than RAM.
             Default: False.
+        persistent_txn (bool, optional): If True, each process and thread
+            keeps one read transaction open and reuses it for every read,
+            instead of beginning a new one per key. Only use it with
+            databases that are not written while being read. Default: True.
     Attributes:
         db_paths (list): Lmdb database path.
         _client (list): A list of several lmdb envs.
     """
 
-    def __init__(self, db_paths, client_keys='default', readonly=True, lock=False, readahead=False, **kwargs):
+    def __init__(self,
+                 db_paths,
+                 client_keys='default',
+                 readonly=True,
+                 lock=False,
+                 readahead=False,
+                 persistent_txn=True,
+                 **kwargs):
         try:
-            import lmdb
+            import lmdb  # noqa: F401
         except ImportError:
             raise ImportError('Please install lmdb to enable LmdbBackend.')
 
@@ -102,9 +305,69 @@ class LmdbBackend(BaseStorageBackend):
         assert len(client_keys) == len(self.db_paths), ('client_keys and db_paths should have the same length, '
                                                         f'but received {len(client_keys)} and {len(self.db_paths)}.')
 
-        self._client = {}
+        self.client_keys = client_keys
+        # lmdb env paths by name: the client key, or client_key/shard for shard folders
+        self._env_paths = {}
+        self._shard_index = {}
         for client, path in zip(client_keys, self.db_paths):
-            self._client[client] = lmdb.open(path, readonly=readonly, lock=lock, readahead=readahead, **kwargs)
+            index_file = osp.join(path, 'shard_index.txt')
+            if not osp.isfile(index_file):
+                self._env_paths[client] = path
+                continue
+            with open(index_file, 'r') as f:
+                self._shard_index[client] = dict(line.split() for line in f if line.strip())
+            for shard in set(self._shard_index[client].values()):
+                self._env_paths[f'{client}/{shard}'] = osp.join(path, shard)
+        self.env_kwargs = dict(readonly=readonly, lock=lock, readahead=readahead, **kwargs)
+        self.persistent_txn = persistent_txn
+        self._pid = None
+        self._client = {}
+        self._txns = {}
+
+    def __getstate__(self):
+        # lmdb envs and transactions can not be pickled, reopen them lazily
+        state = self.__dict__.copy()
+        state.update(_pid=None, _client={}, _txns={})
+        return state
+
+    def _open(self):
+        """Open the lmdb envs once in each process."""
+        import lmdb
+
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._txns = {}
+            self._client = {name: lmdb.open(path, **self.env_kwargs) for name, path in self._env_paths.items()}
+
+    def _env_name(self, key, client_key):
+        """Name of the env holding key, None if a shard index has no such key."""
+        index = self._shard_index.get(client_key)
+        if index is None:
+            return client_key
+        shard = index.get(key)
+        return None if shard is None else f'{client_key}/{shard}'
+
+    def _begin(self, client_key):
+        """Get a read transaction, reused per thread if persistent_txn."""
+        self._open()
+        assert client_key in self._client, (f'client_key {client_key} is not ' 'in lmdb clients.')
+        if not self.persistent_txn:
+            return self._client[client_key].begin(write=False)
+        txn_key = (threading.get_ident(), client_key)
+        txn = self._txns.get(txn_key)
+        if txn is None:
+            txn = self._client[client_key].begin(write=False)
+            self._txns[txn_key] = txn
+        return txn
+
+    def release(self):
+        """Abort the read transactions kept by the calling thread. Threads that
+        stop reading (e.g. a :class:`Prefetcher`) must call it, so that their
+        transactions do not leak nor pin an old snapshot of the database.
+        """
+        ident = threading.get_ident()
+        for txn_key in [k for k in self._txns if k[0] == ident]:
+            self._txns.pop(txn_key).abort()
 
     def get(self, filepath, client_key):
         """Get values according to the filepath from one lmdb named client_key.
@@ -113,16 +376,163 @@ class LmdbBackend(BaseStorageBackend):
             client_key (str): Used for distinguishing differnet lmdb envs.
         """
         filepath = str(filepath)
-        assert client_key in self._client, (f'client_key {client_key} is not ' 'in lmdb clients.')
-        client = self._client[client_key]
-        with client.begin(write=False) as txn:
-            value_buf = txn.get(filepath.encode('ascii'))
+        env_name = self._env_name(filepath, client_key)
+        if env_name is None:
+            return None
+        txn = self._begin(env_name)
+        value_buf = txn.get(filepath.encode('ascii'))
+        if not self.persistent_txn:
+            txn.abort()
         return value_buf
 
+    def get_many(self, filepaths, client_key):
+        """Get values of several keys from one lmdb under a single
+        transaction. Keys are visited in sorted order with one cursor, which
+        turns random reads into a forward scan of the database.
+        Args:
+            filepaths (list[str | obj:`Path`]): The lmdb keys.
+            client_key (str): Used for distinguishing differnet lmdb envs.
+        Returns:
+            list[bytes | None]: Values in the order of ``filepaths``. None
+                for missing keys.
+        """
+        keys = [str(v) for v in filepaths]
+        by_env = {}
+        for key in set(keys):
+            by_env.setdefault(self._env_name(key, client_key), []).append(key)
+        values = {key: None for key in by_env.pop(None, [])}
+        for env_name, env_keys in by_env.items():
+            txn = self._begin(env_name)
+            with txn.cursor() as cursor:
+                for key in sorted(env_keys):
+                    values[key] = cursor.value() if cursor.set_key(key.encode('ascii')) else None
+            if not self.persistent_txn:
+                txn.abort()
+        return [values[key] for key in keys]
+
     def get_text(self, filepath):
         raise NotImplementedError
 
 
+class MmapBackend(BaseStorageBackend):
+    """Memory-mapped array storage backend.
+    Images are stored decoded, as uint8 arrays packed back to back in
+    ``data.bin``, and ``index.txt`` maps each key to its byte offset and
+    shape (one ``key offset h,w,c`` line per image). ``get`` returns a
+    read-only ``np.ndarray`` view into the memory map: there is no copy and
+    no decode step, and all the DataLoader workers share the same pages of
+    the OS page cache. Use ``extract_subimages_mmap`` to build the files.
+    Args:
+        db_paths (str): Folder containing ``data.bin`` and ``index.txt``.
+    """
+
+    def __init__(self, db_paths, **kwargs):
+        self.db_path = str(db_paths)
+        self._index = {}
+        with open(osp.join(self.db_path, 'index.txt'), 'r') as f:
+            for line in f:
+                key, offset, shape = line.split()
+                self._index[key] = (int(offset), tuple(int(v) for v in shape.split(',')))
+        self._pid = None
+        self._data = None
+
+    def __getstate__(self):
+        # do not pickle (i.e. copy) the whole memory map for spawned workers
+        state = self.__dict__.copy()
+        state.update(_pid=None, _data=None)
+        return state
+
+    def get(self, filepath):
+        """Get the image array of a key.
+        Args:
+            filepath (str | obj:`Path`): Here, filepath is the image key.
+        Returns:
+            ndarray: Read-only uint8 image view.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._data = np.memmap(osp.join(self.db_path, 'data.bin'), dtype=np.uint8, mode='r')
+        offset, shape = self._index[str(filepath)]
+        return self._data[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def get_text(self, filepath):
+        raise NotImplementedError
+
+
+class Prefetcher():
+    """Read values in a background thread ahead of their use.
+    It is meant to be created inside each DataLoader worker (e.g. from an
+    ``IterableDataset`` or over the indices of a batch sampler), so reading
+    the next chunk overlaps with decoding and augmenting the current one.
+    Call ``close()`` when the values are not all consumed, so the thread
+    stops and releases its read transactions.
+    Args:
+        file_client (:obj:`FileClient`): Client used to read the values.
+        filepaths (list[str]): Paths (or lmdb keys) in the order of use.
+        client_key (str): Lmdb client key. Default: 'default'.
+        chunk_size (int): Number of values read together with ``get_many``.
+            Default: 32.
+        num_chunks (int): Maximum number of chunks read ahead. Default: 2.
+    """
+
+    def __init__(self, file_client, filepaths, client_key='default', chunk_size=32, num_chunks=2):
+        self.file_client = file_client
+        self.filepaths = list(filepaths)
+        self.client_key = client_key
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=num_chunks)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        """Queue item unless the prefetcher is closed, returns False if it is."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self):
+        try:
+            for i in range(0, len(self.filepaths), self.chunk_size):
+                chunk = self.filepaths[i:i + self.chunk_size]
+                if not self._put(list(zip(chunk, self.file_client.get_many(chunk, self.client_key)))):
+                    return
+        except Exception as e:
+            self._put(e)
+        finally:
+            self.file_client.release()
+        self._put(None)
+
+    def close(self):
+        """Stop the background thread and drop the values read ahead."""
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def __iter__(self):
+        """Yields:
+            tuple(str, bytes): The path and its value, in the given order.
+        """
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield from chunk
+        finally:
+            self.close()
+
+
 class FileClient(object):
     """A general file client to access files in different backend.
     The client loads a file or text in a specified backend from its path
@@ -130,7 +540,7 @@ class FileClient(object):
     accessor with a given name and backend class.
     Attributes:
         backend (str): The storage backend type. Options are "disk",
-            "memcached" and "lmdb".
+            "memcached", "lmdb" and "mmap".
         client (:obj:`BaseStorageBackend`): The backend object.
     """
 
@@ -138,6 +548,7 @@ class FileClient(object):
         'disk': HardDiskBackend,
         'memcached': MemcachedBackend,
         'lmdb': LmdbBackend,
+        'mmap': MmapBackend,
     }
 
     def __init__(self, backend='disk', **kwargs):
@@ -155,5 +566,28 @@ class FileClient(object):
         else:
             return self.client.get(filepath)
 
+    def get_many(self, filepaths, client_key='default'):
+        """Get the values of several files at once.
+        Backends with a batch api (lmdb) read them in a single transaction,
+        the others fall back to one ``get`` per file.
+        """
+        if self.backend == 'lmdb':
+            return self.client.get_many(filepaths, client_key)
+        else:
+            return [self.get(filepath, client_key) for filepath in filepaths]
+
+    def prefetch(self, filepaths, client_key='default', chunk_size=32, num_chunks=2):
+        """Iterate over ``(filepath, value)`` pairs read by a background
+        thread. See :class:`Prefetcher`.
+        """
+        return Prefetcher(self, filepaths, client_key, chunk_size=chunk_size, num_chunks=num_chunks)
+
+    def release(self):
+        """Release the per-thread resources of the backend (lmdb read
+        transactions) held by the calling thread.
+        """
+        if hasattr(self.client, 'release'):
+            self.client.release()
+
     def get_text(self, filepath):
         return self.client.get_text(filepath)
\ No newline at end of file
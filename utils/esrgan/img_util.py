@@ -108,7 +108,9 @@ def tensor2img_fast(tensor, rgb2bgr=True, min_max=(0, 1)):
 def imfrombytes(content, flag='color', float32=False):
     """Read an image from bytes.
     Args:
-        content (bytes): Image bytes got from files or other streams.
+        content (bytes | ndarray): Image bytes got from files or other streams.
+            Decoded arrays (e.g. from the mmap backend) are returned as they
+            are, without decoding and regardless of `flag`.
         flag (str): Flags specifying the color type of a loaded image,
             candidates are `color`, `grayscale` and `unchanged`.
         float32 (bool): Whether to change to float32., If True, will also norm
@@ -116,9 +118,12 @@ def imfrombytes(content, flag='color', float32=False):
     Returns:
         ndarray: Loaded image array.
     """
-    img_np = np.frombuffer(content, np.uint8)
-    imread_flags = {'color': cv2.IMREAD_COLOR, 'grayscale': cv2.IMREAD_GRAYSCALE, 'unchanged': cv2.IMREAD_UNCHANGED}
-    img = cv2.imdecode(img_np, imread_flags[flag])
+    if isinstance(content, np.ndarray):
+        img = content
+    else:
+        img_np = np.frombuffer(content, np.uint8)
+        imread_flags = {'color': cv2.IMREAD_COLOR, 'grayscale': cv2.IMREAD_GRAYSCALE, 'unchanged': cv2.IMREAD_UNCHANGED}
+        img = cv2.imdecode(img_np, imread_flags[flag])
     if float32:
         img = img.astype(np.float32) / 255.
     return img
@@ -0,0 +1,122 @@
+import os
+import hashlib
+
+import torch
+from torch import nn
+
+
+def model_fingerprint(model):
+    """ sha1 of the model class, parameters and buffers, used to key cached engines. """
+    sha = hashlib.sha1(type(model).__name__.encode())
+    for k, v in model.state_dict().items():
+        sha.update(k.encode())
+        sha.update(v.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+class InferenceEngine(nn.Module):
+    """ Compiled inference wrapper of a fully convolutional SR network.
+
+        mode 'trace': torch.jit.trace + freeze (when available), saved to
+            cache_dir per (model, input shape bucket, device, torch version)
+            and reloaded on later runs.
+        mode 'compile': torch.compile (torch >= 2.0), kept in memory only.
+        mode 'eager' or any failure: the model itself.
+
+        Input (H, W) are rounded up to multiples of bucket to key the
+        engines; the first input of every new exact shape is checked against
+        eager mode and shapes that do not match fall back to eager.
+        Parameters stay reachable (model.parameters()) so callers can still
+        look up the device.
+    """
+
+    def __init__(self, model, name, mode='trace', cache_dir=None, bucket=64, atol=1e-4):
+        super().__init__()
+        self.model = model.eval()
+        self.name = name
+        self.mode = mode
+        self.cache_dir = cache_dir or os.path.expanduser('~/.cache/sisr_engines')
+        self.bucket = bucket
+        self.atol = atol
+        self._fingerprint = None
+        self._engines = {}
+        self._checked = {}
+
+        if mode == 'compile' and not hasattr(torch, 'compile'):
+            print(f'{name}: torch.compile is not available, using torch.jit.trace')
+            self.mode = 'trace'
+
+    def __getstate__(self):
+        # compiled engines are not picklable, spawned processes rebuild or reload them
+        state = self.__dict__.copy()
+        state['_engines'] = {}
+        state['_checked'] = {}
+        return state
+
+    def _key(self, x):
+        hb = -(-x.shape[-2] // self.bucket) * self.bucket
+        wb = -(-x.shape[-1] // self.bucket) * self.bucket
+        return (x.shape[-3], hb, wb, str(x.device), x.dtype)
+
+    def _cache_file(self, key):
+        if self._fingerprint is None:
+            self._fingerprint = model_fingerprint(self.model)
+        c, hb, wb, device, dtype = key
+        return os.path.join(
+            self.cache_dir,
+            f'{self.name}_{self._fingerprint}_{c}x{hb}x{wb}_{device.replace(":", "")}_'
+            f'{str(dtype).replace("torch.", "")}_torch{torch.__version__}.pt'
+        )
+
+    def _build(self, x, key):
+        if self.mode == 'compile':
+            return torch.compile(self.model)
+
+        cache_file = self._cache_file(key)
+        if os.path.exists(cache_file):
+            try:
+                return torch.jit.load(cache_file, map_location=x.device)
+            except Exception as e:
+                print(f'{self.name}: could not load {cache_file} ({e}), tracing again')
+
+        engine = torch.jit.trace(self.model, x, check_trace=False)
+        if hasattr(torch.jit, 'freeze'):
+            engine = torch.jit.freeze(engine)
+        if hasattr(torch.jit, 'optimize_for_inference'):
+            engine = torch.jit.optimize_for_inference(engine)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        torch.jit.save(engine, f'{cache_file}.{os.getpid()}.tmp')
+        os.replace(f'{cache_file}.{os.getpid()}.tmp', cache_file)
+        return engine
+
+    @torch.no_grad()
+    def forward(self, x):
+        if self.mode == 'eager':
+            return self.model(x)
+
+        key = self._key(x)
+        if key not in self._engines:
+            try:
+                self._engines[key] = self._build(x, key)
+            except Exception as e:
+                print(f'{self.name}: compiling failed ({e}), using eager mode for {tuple(x.shape)}')
+                self._engines[key] = None
+        engine = self._engines[key]
+        if engine is None:
+            return self.model(x)
+
+        shape = tuple(x.shape)
+        if shape not in self._checked:
+            ref = self.model(x)
+            try:
+                out = engine(x)
+                self._checked[shape] = out.shape == ref.shape and torch.allclose(out, ref, atol=self.atol)
+            except Exception:
+                self._checked[shape] = False
+            if not self._checked[shape]:
+                print(f'{self.name}: compiled engine does not match eager mode for {shape}, using eager mode')
+            return ref
+        if not self._checked[shape]:
+            return self.model(x)
+        return engine(x)
@@ -2,6 +2,8 @@ import os
 import time
 import shutil
 import math
+import random
+import functools
 import cv2
 
 import torch
@@ -127,6 +129,38 @@ def to_pixel_samples(img):
     return coord, rgb
 
 
+@functools.lru_cache(maxsize=16)
+def _cached_coord(h, w):
+    """ Flattened make_coord grid, built once per crop size.
+        Callers must not modify it in place.
+    """
+    return make_coord((h, w))
+
+
+@functools.lru_cache(maxsize=32)
+def cached_feat_coord(h, w, device, dtype):
+    """ Unflattened make_coord grid of a (h, w) feature map on device/dtype,
+        built once per (shape, device, dtype).
+        Callers must not modify it in place.
+    """
+    return make_coord((h, w), flatten=False).to(device=device, dtype=dtype)
+
+
+def sample_pixel_samples(img, sample_q):
+    """ Sample sample_q coord-RGB pairs of the image without replacement.
+        Same as to_pixel_samples followed by picking sample_q random rows,
+        but only the sampled pixels are gathered: O(sample_q), not O(H*W).
+        img: Tensor, (3, H, W)
+    """
+    h, w = img.shape[-2:]
+    idx = random.sample(range(h * w), sample_q)
+    rows = torch.tensor([i // w for i in idx], dtype=torch.long)
+    cols = torch.tensor([i % w for i in idx], dtype=torch.long)
+    coord = _cached_coord(h, w)[torch.tensor(idx, dtype=torch.long)]
+    rgb = img[:, rows, cols].permute(1, 0)
+    return coord, rgb
+
+
 def calc_psnr(sr, hr, dataset=None, scale=1, rgb_range=1):
     diff = (sr - hr) / rgb_range
     if dataset is not None:
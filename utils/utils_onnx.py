@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+
+def export_onnx(model, example_input, onnx_file, spatial=True, opset_version=11):
+    """ Export model to onnx_file with a dynamic batch axis, plus dynamic
+        height / width axes if spatial (images in and out; otherwise e.g.
+        the (N, in_dim) queries of the LIIF imnet).
+        The export goes through a temporary file, so a crash never leaves a
+        truncated model behind.
+    """
+    import torch
+
+    if spatial:
+        dynamic_axes = {'input': {0: 'batch', 2: 'height', 3: 'width'},
+                        'output': {0: 'batch', 2: 'out_height', 3: 'out_width'}}
+    else:
+        dynamic_axes = {'input': {0: 'batch'}, 'output': {0: 'batch'}}
+
+    os.makedirs(os.path.dirname(onnx_file), exist_ok=True)
+    tmp_file = f'{onnx_file}.{os.getpid()}.tmp'
+    model = model.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            model, example_input, tmp_file,
+            input_names=['input'], output_names=['output'],
+            dynamic_axes=dynamic_axes, opset_version=opset_version
+        )
+    os.replace(tmp_file, onnx_file)
+    return onnx_file
+
+
+class OrtModel():
+    """ ONNX Runtime CPU model with the call interface of the torch model.
+
+        Torch tensors in give torch tensors out (on the CPU), numpy arrays
+        give numpy arrays, so inference-only code does not need torch.
+        The session is created lazily in every process, with
+        intra_op_num_threads threads (default: the cores this process may
+        run on, see os.sched_getaffinity); cores pins the process first.
+    """
+
+    def __init__(self, onnx_file, intra_op_num_threads=None, cores=None):
+        self.onnx_file = onnx_file
+        self.intra_op_num_threads = intra_op_num_threads
+        self.cores = cores
+        self._session = None
+        self._session_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_session'] = None
+        state['_session_pid'] = None
+        return state
+
+    def _get_session(self):
+        if self._session_pid != os.getpid():
+            import onnxruntime as ort
+
+            if self.cores is not None and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, self.cores)
+            threads = self.intra_op_num_threads
+            if threads is None:
+                threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+            options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._session = ort.InferenceSession(
+                self.onnx_file, sess_options=options, providers=['CPUExecutionProvider']
+            )
+            self._session_pid = os.getpid()
+        return self._session
+
+    def parameters(self):
+        # no torch parameters: callers looking up the device fall back to the cpu
+        return iter(())
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        is_tensor = not isinstance(x, np.ndarray)
+        inp = x.detach().cpu().float().numpy() if is_tensor else x.astype(np.float32, copy=False)
+        out = self._get_session().run(None, {'input': inp})[0]
+        if is_tensor:
+            import torch
+            return torch.from_numpy(out)
+        return out
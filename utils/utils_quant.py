@@ -0,0 +1,117 @@
+import os
+import copy
+import json
+import inspect
+import hashlib
+
+import torch
+from torch import nn
+
+from utils.utils_engine import model_fingerprint
+
+
+class InputRecorder(nn.Module):
+    """ Runs a model and keeps a CPU copy of every input, used to collect
+        calibration inputs through the regular inference code.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.inputs = []
+
+    @torch.no_grad()
+    def forward(self, x):
+        self.inputs.append(x.detach().cpu().clone())
+        return self.model(x)
+
+
+class QuantizedModel(nn.Module):
+    """ int8 CPU model, inputs are moved to the CPU. """
+
+    def __init__(self, qmodel):
+        super().__init__()
+        self.qmodel = qmodel
+
+    @torch.no_grad()
+    def forward(self, x):
+        return self.qmodel(x.cpu().float())
+
+
+def _prepare_fx(model, qconfig, example_input):
+    from torch.quantization import quantize_fx
+    if 'example_inputs' in inspect.signature(quantize_fx.prepare_fx).parameters:
+        return quantize_fx.prepare_fx(model, {'': qconfig}, example_inputs=(example_input,))
+    return quantize_fx.prepare_fx(model, {'': qconfig})
+
+
+def quantize_static(model, calib_inputs, backend='fbgemm'):
+    """ Post-training static int8 quantization (FX graph mode, so residual
+        adds, concats and clones need no model changes) calibrated on
+        calib_inputs. Returns a traced TorchScript module running on the CPU.
+    """
+    if backend not in torch.backends.quantized.supported_engines:
+        raise RuntimeError(f'quantized engine {backend} is not supported by this torch build')
+    torch.backends.quantized.engine = backend
+    from torch.quantization import quantize_fx
+
+    model = copy.deepcopy(model).cpu().float().eval()
+    qconfig = torch.quantization.get_default_qconfig(backend)
+    prepared = _prepare_fx(model, qconfig, calib_inputs[0])
+    with torch.no_grad():
+        for x in calib_inputs:
+            prepared(x)
+    qmodel = quantize_fx.convert_fx(prepared)
+    with torch.no_grad():
+        qmodel = torch.jit.trace(qmodel, calib_inputs[0]).eval()
+    if hasattr(torch.jit, 'freeze'):
+        qmodel = torch.jit.freeze(qmodel)
+    return qmodel
+
+
+def calib_hash(names):
+    """ Short hash of the calibration image names. """
+    return hashlib.sha1('\n'.join(sorted(names)).encode()).hexdigest()[:8]
+
+
+def load_or_quantize(model, name, calibrate, calib_names, backend='fbgemm', cache_dir=None):
+    """ Cached quantize_static.
+        calibrate(model) must run the calibration images through model
+        (an InputRecorder); it is only called when there is no cached model.
+        The returned info holds the cache file and, when just quantized,
+        the recorded calibration inputs to measure the drift.
+        Returns (QuantizedModel, info).
+    """
+    cache_dir = cache_dir or os.path.expanduser('~/.cache/sisr_engines')
+    cache_file = os.path.join(
+        cache_dir,
+        f'{name}_{model_fingerprint(model)}_{backend}_{calib_hash(calib_names)}'
+        f'_torch{torch.__version__}_int8.pt'
+    )
+    info = {'cache_file': cache_file, 'inputs': None}
+    if os.path.exists(cache_file):
+        torch.backends.quantized.engine = backend
+        info['drift'] = load_drift(cache_file)
+        return QuantizedModel(torch.jit.load(cache_file, map_location='cpu')), info
+
+    recorder = InputRecorder(model)
+    calibrate(recorder)
+    qmodel = quantize_static(model, recorder.inputs, backend)
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.jit.save(qmodel, f'{cache_file}.{os.getpid()}.tmp')
+    os.replace(f'{cache_file}.{os.getpid()}.tmp', cache_file)
+    info['inputs'] = recorder.inputs
+    return QuantizedModel(qmodel), info
+
+
+def save_drift(cache_file, drift):
+    with open(os.path.splitext(cache_file)[0] + '_drift.json', 'w') as f:
+        json.dump(drift, f)
+
+
+def load_drift(cache_file):
+    drift_file = os.path.splitext(cache_file)[0] + '_drift.json'
+    if not os.path.exists(drift_file):
+        return None
+    with open(drift_file) as f:
+        return json.load(f)